@@ -1,6 +1,6 @@
 # file that defines your database tables in Postgresql using SQLAlchemy ORM
 from sqlalchemy import (
-    String, Boolean, Text, DECIMAL, ForeignKey, DateTime, Integer, UUID
+    String, Boolean, Text, DECIMAL, ForeignKey, DateTime, Integer, UUID, Index
 )
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from datetime import datetime
@@ -28,6 +28,11 @@ class Course(Base):
     prereq_text: Mapped[str] = mapped_column(Text, default="")
     coreq_text: Mapped[str] = mapped_column(Text, default="")
 
+    # HTTP validators the catalogue page was last served with. update_prereq_text
+    # sends them back, and a 304 Not Modified means there is nothing to re-parse.
+    etag: Mapped[str | None] = mapped_column(String, nullable=True)
+    last_modified: Mapped[str | None] = mapped_column(String, nullable=True)
+
 
 # 3) Table for prerequisites (edges between courses)
 class PrereqEdge(Base):
@@ -37,6 +42,10 @@ class PrereqEdge(Base):
     dst_course_id: Mapped[str] = mapped_column(ForeignKey("courses.id"), primary_key=True)
     kind: Mapped[str] = mapped_column(String, primary_key=True)  # "prereq", "coreq", etc.
 
+    # get_prereqs()/get_coreqs() look edges up by (dst_course_id, kind). The primary
+    # key index starts with src_course_id, so it can't serve that lookup on its own.
+    __table_args__ = (Index("ix_prereq_edge_dst_kind", "dst_course_id", "kind"),)
+
 
 # ──────────────────────────────────────────────────────────────
 # USER TABLES (linked to Supabase Auth via user_id = auth.users.id)
@@ -80,7 +89,7 @@ class UserCourse(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
 
     # Which user this belongs to (FK to Supabase Auth)
-    user_id: Mapped[uuid.UUID] = mapped_column(UUID, nullable=False)
+    user_id: Mapped[uuid.UUID] = mapped_column(UUID, nullable=False, index=True)  # every profile load filters on it
 
     # Which course (FK to our courses table, e.g., "COMP-250")
     course_id: Mapped[str] = mapped_column(ForeignKey("courses.id"), nullable=False)
@@ -1,5 +1,6 @@
 # deterministic_logic.py
 import re
+from sqlalchemy import select
 from db_connection import Session as DBSession
 from db_setup import Course, PrereqEdge
 
@@ -23,26 +24,75 @@ def get_coreqs(course_id: str):
         )
         return [c[0] for c in coreqs]
 
-def get_courses_requiring(course_id: str):
-    """Return a list of courses that list this course as a prerequisite."""
-    if not course_id:
-        return []
+# Columns of the enriched course dict used across retrieval (see rag_layer.enrich_context),
+# labelled with the dict's key names. Selecting these as plain Core rows skips ORM
+# object construction and instrumented attribute access; dict(row._mapping) then
+# gives the final dict directly.
+COURSE_DICT_COLUMNS = (
+    Course.id,
+    Course.title,
+    Course.offered_by.label("department"),
+    Course.credits,
+    Course.offered_fall,
+    Course.offered_winter,
+    Course.offered_summer,
+    Course.prereq_text.label("prereqs"),
+    Course.coreq_text.label("coreqs"),
+    Course.description,
+)
+
+
+def course_to_dict(row) -> dict:
+    """Turn a row selected with COURSE_DICT_COLUMNS into the enriched course dict."""
+    d = dict(row._mapping)
+    d["credits"] = float(d["credits"] or 0)  # DECIMAL → float for JSON/prompt formatting
+    return d
 
+
+def _requiring_filter(course_id: str):
+    """Build (SQL prefilter, exact regex) for courses whose prereq_text mentions course_id."""
     # Normalize variants: COMP250, COMP-250 → COMP 250
     normalized = course_id.replace("-", " ").upper()
     # Match COMP250, COMP-250, COMP 250
     pattern = re.compile(rf'\b{normalized.replace(" ", "[- ]?")}\b', re.IGNORECASE)
+    # Cheap superset check Postgres can do itself ("%COMP%250%" covers all three
+    # spellings), so only candidate rows come back for the exact regex test.
+    prefilter = Course.prereq_text.ilike(f"%{'%'.join(normalized.split())}%")
+    return prefilter, pattern
+
+
+def get_courses_requiring(course_id: str):
+    """Return a list of courses that list this course as a prerequisite."""
+    if not course_id:
+        return []
+
+    prefilter, pattern = _requiring_filter(course_id)
     with DBSession() as session:
         matches = []
         # Query courses that have prerequisite text
         # This tells SQLAlechemy “I only care about the id and prereq_text columns from the Course table.”
         #
-        results = session.query(Course.id, Course.prereq_text).filter(Course.prereq_text.isnot(None)).all() # Adds a SQL condition so you only pull rows where the prereq_text field isn’t null.
+        results = session.query(Course.id, Course.prereq_text).filter(prefilter).all() # ILIKE also drops rows where prereq_text is null
         for cid, text in results:
             if text and pattern.search(text):
                 matches.append(cid)
     return matches
 
+
+def get_courses_requiring_enriched(course_id: str) -> list[dict]:
+    """Like get_courses_requiring(), but return full course dicts in the same single query.
+
+    Saves the second round-trip of get_courses_requiring() followed by
+    enrich_context(): the candidate rows already carry every column we need.
+    """
+    if not course_id:
+        return []
+
+    prefilter, pattern = _requiring_filter(course_id)
+    with DBSession() as session:
+        rows = session.execute(select(*COURSE_DICT_COLUMNS).where(prefilter))
+        return [course_to_dict(r) for r in rows if r.prereqs and pattern.search(r.prereqs)]
+
     # with DBSession() as session:
     #     required = ( # courses that require the given course as a prerequisite
     #         session.query(PrereqEdge.dst_course_id) 
@@ -1,9 +1,24 @@
 # ensure_columns.py
+# Brings an existing database up to the columns and indexes declared in db_setup.py.
+# Every statement is IF NOT EXISTS, so it's safe (and quick) to run on each start:
+# the server and the scraper/update scripts call ensure_columns() before touching
+# the courses table; `python ensure_columns.py` runs it by hand.
 from sqlalchemy import text
 from db_connection import engine
 
-with engine.begin() as conn:
-    conn.execute(text("ALTER TABLE courses ADD COLUMN IF NOT EXISTS prereq_text TEXT"))
-    conn.execute(text("ALTER TABLE courses ADD COLUMN IF NOT EXISTS coreq_text TEXT"))
 
-print("✅ Columns ensured successfully.")
+def ensure_columns():
+    """Add any missing columns/indexes from db_setup.py to the existing tables."""
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE courses ADD COLUMN IF NOT EXISTS prereq_text TEXT"))
+        conn.execute(text("ALTER TABLE courses ADD COLUMN IF NOT EXISTS coreq_text TEXT"))
+        conn.execute(text("ALTER TABLE courses ADD COLUMN IF NOT EXISTS etag VARCHAR"))
+        conn.execute(text("ALTER TABLE courses ADD COLUMN IF NOT EXISTS last_modified VARCHAR"))
+        # Indexes declared in db_setup.py, for databases created before they were added
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_prereq_edge_dst_kind ON prereq_edge (dst_course_id, kind)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_user_courses_user_id ON user_courses (user_id)"))
+
+
+if __name__ == "__main__":
+    ensure_columns()
+    print("✅ Columns and indexes ensured successfully.")
@@ -12,25 +12,29 @@
 # find relevant facts ourselves and paste them into the prompt as context. The LLM
 # then just has to read and summarize — a task it's very good at.
 
-import pathlib
+import asyncio
+import functools
 import os
 import re
-from dotenv import load_dotenv
-from deterministic_logic import get_courses_requiring
+# Importing anything that touches the DB pulls in db_connection, which loads
+# backend/.env once for the whole process (works locally; on Railway, env vars
+# are set in the dashboard). So there's no separate load_dotenv() call here.
+from deterministic_logic import get_courses_requiring_enriched
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# SETUP: Load environment variables and initialize the LLM
+# SETUP: Initialize the LLM
 #
-# dotenv reads key=value pairs from the .env file into os.environ so the rest
-# of the code can call os.getenv("KEY") without hardcoding secrets.
+# dotenv has already read key=value pairs from backend/.env into os.environ
+# (see db_connection.py), so we can call os.getenv("KEY") without hardcoding secrets.
 # ─────────────────────────────────────────────────────────────────────────────
 
-# Load .env from the backend directory (works locally; on Railway, env vars are set in dashboard)
-env_path = pathlib.Path(__file__).parent / ".env"
-load_dotenv(env_path, override=True)
 from langchain_openai import ChatOpenAI
-from rag_layer import hybrid_search, enrich_context, set_llm
+from langchain_core.messages import HumanMessage, SystemMessage
+from rag_layer import (
+    hybrid_search_async, enrich_context_async, get_course_directly_async,
+    semantic_search_async, set_llm,
+)
 
 # Quick sanity check — fail loudly at startup rather than silently mid-request
 if not os.getenv("OPENAI_API_KEY"):
@@ -77,7 +81,85 @@ def format_course_label(course_id: str, title: str) -> str:
     return course_id
 
 
-def _retrieve_comparison_programs(query: str) -> list | None:
+@functools.lru_cache(maxsize=8)
+def _format_offering(fall: bool, winter: bool, summer: bool) -> str:
+    """Offering string for one combination of term flags (only 8 exist, so cache them all)."""
+    terms = []
+    if fall:
+        terms.append('Fall')
+    if winter:
+        terms.append('Winter')
+    if summer:
+        terms.append('Summer')
+    return ', '.join(terms) if terms else 'Not specified'
+
+
+def format_offering(d: dict) -> str:
+    """Format the offering terms for a course (e.g. 'Fall, Winter')."""
+    return _format_offering(bool(d.get('offered_fall')), bool(d.get('offered_winter')), bool(d.get('offered_summer')))
+
+
+# Descriptions are by far the longest part of each course block, and prompt tokens
+# drive both latency and cost. Only the top few directly-retrieved courses keep
+# their full description; every other block gets a short word-boundary preview.
+FULL_DESCRIPTION_TOP_K = 5
+SUPPORT_DESCRIPTION_CHARS = 120
+
+# Formatted course blocks are memoized on the values that go into them, not on the
+# course id: the catalogue can change under a running server (refresh_course_cache(),
+# update_prereq_text), and an edited course then simply formats to a new entry.
+# Popular courses (COMP 250, MATH 133...) show up in most prompts, so this saves
+# rebuilding their block every request.
+COURSE_BLOCK_CACHE_SIZE = 2048
+
+
+def format_description(d: dict, full: bool) -> str:
+    """Full description, or a word-boundary preview when `full` is False."""
+    description = d.get('description')
+    if not description or description == 'N/A':
+        return 'No description available.'
+    if full or len(description) <= SUPPORT_DESCRIPTION_CHARS:
+        return description
+    return description[:SUPPORT_DESCRIPTION_CHARS].rsplit(' ', 1)[0] + '…'
+
+
+def format_course(d: dict, full_description: bool = True) -> str:
+    """Format one enriched course as a readable prompt block (memoized, see COURSE_BLOCK_CACHE_SIZE).
+
+    format_course_label strips placeholder titles so a course with no real title
+    appears as just "COMP 314" (no parenthetical).
+    """
+    return _format_course_block(
+        d['id'], d.get('title', ''), d['credits'], d['department'],
+        format_description(d, full_description), d['prereqs'], d['coreqs'], format_offering(d),
+    )
+
+
+@functools.lru_cache(maxsize=COURSE_BLOCK_CACHE_SIZE)
+def _format_course_block(course_id, title, credits, department, description, prereqs, coreqs, offering) -> str:
+    """format_course() for the already-extracted field values."""
+    return (
+        f"{format_course_label(course_id, title)} - {credits} credits, {department}\n"
+        f"Description: {description}\n"
+        f"Prereqs: {prereqs or 'None'}\n"
+        f"Coreqs: {coreqs or 'None'}\n"
+        f"Offered: {offering}"
+    )
+
+
+# Comparison phrasings for _retrieve_comparison_programs(), compiled once at import.
+# We try most specific patterns first to avoid over-matching.
+_COMPARISON_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    # "difference between X and Y"
+    r'\bbetween\s+(.+?)\s+\band\b\s+(.+?)(?:\?|$)',
+    # "what extra does X require that/vs Y"
+    r'\b(?:extra|more|different).{0,20}?\b((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor|Program|BSc|BA))\b.{0,20}?\b(?:vs\.?|versus|than|that|compared to)\b.{0,10}?\b((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor|Program|BSc|BA))\b',
+    # "X vs Y"
+    r'\b((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor))\s+(?:vs\.?|versus)\s+((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor))',
+))
+
+
+async def _retrieve_comparison_programs(query: str) -> list | None:
     """When the student asks to compare two programs, retrieve targeted program chunks for each.
 
     For 'What's the difference between CS Honours and CS Major?', this runs:
@@ -92,19 +174,11 @@ def _retrieve_comparison_programs(query: str) -> list | None:
     Returns a list of up to 2 retrieved_doc dicts (each has 'program_text', 'program_name', etc.)
     or None if this doesn't look like a comparison query.
     """
-    # Try several comparison phrasings to extract the two program names.
-    # We try most specific patterns first to avoid over-matching.
-    patterns = [
-        # "difference between X and Y"
-        r'\bbetween\s+(.+?)\s+\band\b\s+(.+?)(?:\?|$)',
-        # "what extra does X require that/vs Y"
-        r'\b(?:extra|more|different).{0,20}?\b((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor|Program|BSc|BA))\b.{0,20}?\b(?:vs\.?|versus|than|that|compared to)\b.{0,10}?\b((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor|Program|BSc|BA))\b',
-        # "X vs Y"
-        r'\b((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor))\s+(?:vs\.?|versus)\s+((?:CS|[A-Z]\w+)\s+(?:Honours?|Major|Minor))',
-    ]
+    # Try several comparison phrasings to extract the two program names
+    # (_COMPARISON_PATTERNS, most specific first).
     m = None
-    for pat in patterns:
-        m = re.search(pat, query, re.IGNORECASE)
+    for pattern in _COMPARISON_PATTERNS:
+        m = pattern.search(query)
         if m:
             break
 
@@ -114,23 +188,47 @@ def _retrieve_comparison_programs(query: str) -> list | None:
     term_a = m.group(1).strip()
     term_b = m.group(2).strip()
 
-    from rag_layer import semantic_search as _sem_search
-
-    def _top_program(term: str) -> dict | None:
+    async def _top_program(term: str) -> dict | None:
         """Find the best-matching program chunk for a query term."""
-        results = _sem_search(f"{term} program requirements", n_results=5)
+        results = await semantic_search_async(f"{term} program requirements", n_results=5)
         for r in results:
             if r.get("course_id", "").startswith("program::") and r.get("program_text"):
                 return r
         return None
 
-    prog_a = _top_program(term_a)
-    prog_b = _top_program(term_b)
+    # Both searches go out together, so they land in the same embedding batch
+    prog_a, prog_b = await asyncio.gather(_top_program(term_a), _top_program(term_b))
 
     results = [r for r in [prog_a, prog_b] if r]
     return results if results else None
 
 
+# detect_query_type() phrase lists. Each list is joined into ONE alternation and
+# compiled once, so classifying a question is (at most) two regex scans instead of
+# up to 13 separate re.search calls. "Does any phrase match anywhere" is exactly
+# what a search over the alternation answers, so results are unchanged. The two
+# lists stay separate because prereq_chain must win whenever both kinds match.
+_PREREQ_CHAIN_RE = re.compile("|".join([
+    # These patterns catch "should I take X before Y" style questions
+    r'should i take .+ before',
+    r'do i need .+ before',
+    r'is .+ required (for|before)',
+    r'take .+ before .+\?',
+    r'need .+ (for|to take)',
+]))
+_REVERSE_PREREQ_RE = re.compile("|".join([
+    # These patterns catch "what comes after X" style questions
+    r"what can i take after",
+    r"what should i take after",
+    r"what courses? require",
+    r"i finished .+,? what'?s next",
+    r"after .+,? what",
+    r"courses? that need",
+    r"what('s| is) next after",
+    r"take after",
+]))
+
+
 def detect_query_type(query: str):
     """Classify the question as 'prereq_chain', 'reverse_prereq', or generic 'prereq'.
 
@@ -143,69 +241,147 @@ def detect_query_type(query: str):
     - prereq:         Everything else                            → fall through to the LLM
     """
     query_lower = query.lower()
+    if _PREREQ_CHAIN_RE.search(query_lower):
+        return "prereq_chain"
+    if _REVERSE_PREREQ_RE.search(query_lower):
+        return "reverse_prereq"
+    return "prereq"
 
-    # These patterns catch "should I take X before Y" style questions
-    prereq_chain_patterns = [
-        r'should i take .+ before',
-        r'do i need .+ before',
-        r'is .+ required (for|before)',
-        r'take .+ before .+\?',
-        r'need .+ (for|to take)',
-    ]
-    for pattern in prereq_chain_patterns:
-        if re.search(pattern, query_lower):
-            return "prereq_chain"
 
-    # These patterns catch "what comes after X" style questions
-    reverse_patterns = [
-        r"what can i take after",
-        r"what should i take after",
-        r"what courses? require",
-        r"i finished .+,? what'?s next",
-        r"after .+,? what",
-        r"courses? that need",
-        r"what('s| is) next after",
-        r"take after",
-    ]
-    for pattern in reverse_patterns:
-        if re.search(pattern, query_lower):
-            return "reverse_prereq"
-    return "prereq"
+# ─────────────────────────────────────────────────────────────────────────────
+# SYSTEM PROMPT
+#
+# Tells the LLM:
+#   - Who it is (McGill assistant)
+#   - The rules it must follow (use only context, be concise, etc.)
+#   - Common student phrasings to watch out for
+#
+# Prompt engineering is iterative — these rules were added one by one as the
+# LLM got things wrong in testing. Each rule is a lesson learned.
+#
+# This text never changes between requests, so it's sent as the system message.
+# OpenAI caches repeated prompt prefixes server-side, which makes these tokens
+# cheaper and faster after the first call. Anything that varies per question
+# belongs in the human message built in _prepare_answer(), not here.
+# ─────────────────────────────────────────────────────────────────────────────
+
+SYSTEM_PROMPT = """You are a helpful academic assistant for McGill University. Use "I" naturally, keep it casual and conversational.
+Use only the context in the student's message to answer the student's question.
+
+[COMMON COURSE NICKNAMES]
+Students often use nicknames for courses. Here are the mappings:
+- "Calc 1" / "Calculus 1" = MATH 140
+- "Calc 2" / "Calculus 2" = MATH 141
+- "Calc 3" / "Calculus 3" = MATH 222
+- "Linear Algebra" / "Lin Alg" = MATH 133
+- "Discrete Math" / "Discrete" = MATH 240
+- "ODE" = MATH 323
+- "PDE" = MATH 324
+- "Real Analysis" = MATH 242
+- "Intro to CS" / "Intro CS" = COMP 202
+- "Data Structures" = COMP 250
+- "Algorithms" = COMP 251
+- "Operating Systems" / "OS" = COMP 310
+- "Databases" = COMP 421
+- "AI" = COMP 424
+- "Machine Learning" / "ML" = COMP 551
+- "Compilers" = COMP 520
+- "Computer Graphics" / "Graphics" = COMP 557
+
+When a student uses a nickname, treat it as the corresponding course code.
+
+[UNDERSTANDING STUDENT QUESTIONS]
+Students ask about prerequisites in different ways. These mean the SAME thing:
+- "What are the prerequisites for X?" = "What do I need before X?" = "What's required for X?"
+- "Which courses require X?" = "What can I take after X?" = "What courses need X?" = "I finished X, what's next?"
+
+[CRITICAL RULES]
+- Use ONLY the context provided — do NOT make up information.
+- If the context doesn't contain the answer, say "I don't have enough information to answer that."
+- When listing courses, include ALL matches from the context.
+- For prerequisite questions: look at the "Prereqs:" field of the course asked about.
+- For "what requires X" questions: look for courses where X appears in their "Prereqs:" field.
+- If a course has no description available, follow the eCalendar note in the student's message instead of saying "No description available."
+
+**RESPONSE FORMAT:**
+- Course titles are already embedded in the context next to their codes, like "COMP 252 (Honours Algorithms and Data Structures)". Always include the title in parentheses when writing a course — copy it exactly as it appears in the context.
+- If a course code appears with no parenthetical title anywhere in the context, list it by code only. Never invent or guess a title.
+- When listing prerequisites, format as: "Prerequisites: COMP 202 (Foundations of Programming)"
+- When describing program requirements, ALWAYS mention both required courses AND complementary/elective courses if both are listed in the context.
+- Be concise. Answer the question directly — never repeat information, never list the same course twice, never add context the student didn't ask for.
+- **COMPARISON QUESTIONS:** When asked what's different or extra between two programs:
+  - First, identify which two programs the student named in their question. ONLY compare those two. Ignore all other programs in the context, even if they look similar.
+  - Reason through the comparison INTERNALLY. Do NOT list both programs' courses in your answer — students don't need to see the intermediate work, only the final result.
+  - Only output the courses that are exclusively in one program and not the other.
+  - Pay attention to direction. "What extra does Honours require compared to Major?" means: courses in Honours that are NOT in Major. Do NOT include courses that are only in the Major — those are not extra requirements for Honours.
+  - A course that appears in BOTH programs is shared and must not appear in the differences.
+  - If two programs each require a different version of a related course (e.g. Honours has COMP 252 while Major has COMP 251), say "COMP 252 instead of COMP 251" rather than listing each as a separate difference.
+
+**TIMING & YEAR QUESTIONS:**
+When a student asks "should I take X in first year or second year?" or "when should I take X?":
+- Look at the course's prerequisites and corequisites
+- Think about when those prereqs are typically completed (100-level = first year, 200-level = second year, etc.)
+- Give a specific recommendation based on the prereq chain, e.g.: "COMP 307 requires COMP 206 and COMP 250, which are typically first-year courses. So second year is the earliest you could take it."
+- Do NOT list unrelated entry-level courses. Focus on the specific course asked about.
+
+**IMPORTANT RULES FOR COREQUISITES:**
+A corequisite is a course that must be taken concurrently with OR may have been taken prior to another course.
+
+This means:
+- If Course A is a corequisite for Course B, a student can take B if they:
+  1. Take A at the SAME TIME as B, OR
+  2. Have ALREADY completed A in a previous semester
+
+- Corequisites are NOT prerequisites. A student does NOT need to complete the corequisite before taking the course.
+
+**Example:**
+- COMP 273 has COMP 206 as a corequisite (not a prerequisite)
+- This means: You can take COMP 273 if you're taking COMP 206 at the same time, OR if you've already completed COMP 206
+- You do NOT need to finish COMP 206 before starting COMP 273
+"""
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# MAIN PIPELINE: generate_answer(query, user_context)
+# MAIN PIPELINE: generate_answer(query, user_context) / stream_answer(...)
 #
-# This is the only function called from server.py. It returns a dict:
+# generate_answer_async() is what server.py awaits for /query. It returns a dict:
 #   { "answer": "...", "sources": [...] }
+# generate_answer() is the same thing for plain sync scripts.
+# stream_answer() runs the exact same pipeline but yields the answer text piece
+# by piece as the LLM writes it, so the student sees words after a few hundred
+# ms instead of waiting for the whole response.
+#
+# All of them share _prepare_answer_async(), which does everything up to the LLM
+# call. It's async so retrieval, DB lookups and routing can overlap.
 #
 # user_context is an optional string injected into the prompt when the student
 # is signed in. It looks like "[STUDENT PROFILE]\nYear: U1\nMajor: CS\n...".
 # When it's None (anonymous user), the LLM answers generically.
 # ─────────────────────────────────────────────────────────────────────────────
 
-def generate_answer(query, user_context=None):
+def inject_titles(text: str, enriched_by_id: dict) -> str:
+    """Post-process an LLM answer: add titles to bare course codes.
 
-    # ── STEP 1: RETRIEVE ────────────────────────────────────────────────────
-    # hybrid_search() queries ChromaDB (vector similarity) and supplements the
-    # results with deterministic SQL logic (e.g. department filters, entry-level
-    # courses). It returns a list of dicts, each with at least a "course_id" key.
-    #
-    # We run this BEFORE query type detection because the planner inside
-    # hybrid_search also infers things like department intent (e.g. "COMP courses
-    # in fall") that we'd otherwise miss.
-    retrieved_docs = hybrid_search(query)
+    Even with the title injection into program prose, the LLM sometimes copies
+    course codes without their titles. As a reliable fallback, we scan the
+    answer for bare course codes (e.g. "COMP 252") and replace them with the
+    full label ("COMP 252 (Honours Algorithms and Data Structures)") using the
+    enriched_by_id map we already have. This runs purely in Python — no extra
+    LLM call needed.
 
-    # ── STEP 2: QUERY ROUTING ───────────────────────────────────────────────
-    # For a handful of question shapes we can answer deterministically — no LLM
-    # needed. We check those here and return early if one matches.
-    # This is faster, cheaper, and avoids hallucinations for simple lookups.
-    query_type = detect_query_type(query)
+    The regex matches patterns like "COMP 252" or "MATH 340" that are NOT
+    already followed by a parenthesis (so we don't double-wrap existing labels).
+    """
+    def replace_code(m):
+        dept, num = m.group(1), m.group(2)
+        db_id = f"{dept} {num}"           # "COMP 252" — DB uses spaces, not hyphens
+        d = enriched_by_id.get(db_id, {})
+        return format_course_label(db_id, d.get("title", ""))
+    return re.sub(r'\b([A-Z]{3,4}) (\d{3}[A-Z]?)\b(?!\s*\()', replace_code, text)
 
-    # Extract the first course code mentioned in the query (e.g. "COMP 250")
-    # re.search scans the uppercased query for a DEPT + NUMBER pattern.
-    match = re.search(r'\b([A-Z]{3,4})[\s\-]?(\d{3}[A-Z]?)\b', query.upper())
-    course_id = f"{match.group(1)} {match.group(2)}" if match else ""
+
+async def _answer_deterministically(query, query_type, match):
+    """Handlers A and B: answer prereq questions straight from the DB, or return None."""
 
     # ── HANDLER A: "Should I take X before Y?" ──────────────────────────────
     # We look up both courses directly in the DB and check whether one appears
@@ -216,9 +392,10 @@ def generate_answer(query, user_context=None):
             first_course = f"{codes[0][0]} {codes[0][1]}"
             second_course = f"{codes[1][0]} {codes[1][1]}"
 
-            from rag_layer import get_course_directly
-            target = get_course_directly(second_course)
-            first_info = get_course_directly(first_course)
+            target, first_info = await asyncio.gather(
+                get_course_directly_async(second_course),
+                get_course_directly_async(first_course),
+            )
 
             if not target:
                 return {"answer": f"I couldn't find **{second_course}** in the database. Please check the course code.", "sources": []}
@@ -266,23 +443,80 @@ def generate_answer(query, user_context=None):
                 return {"answer": text, "sources": []}
 
     # ── HANDLER B: "What can I take after X?" ───────────────────────────────
-    # get_courses_requiring() does a SQL query: find all courses where course_id
-    # appears in their prereq_text. Pure DB lookup, no LLM.
+    # get_courses_requiring_enriched() does one SQL query: find all courses where
+    # course_id appears in their prereq_text, with their titles. Pure DB lookup, no LLM.
     if match and query_type == "reverse_prereq":
         course_id = f"{match.group(1)} {match.group(2)}"
-        courses = get_courses_requiring(course_id)
+        courses, source_info = await asyncio.gather(
+            asyncio.to_thread(get_courses_requiring_enriched, course_id),
+            get_course_directly_async(course_id),
+        )
         if courses:
-            from rag_layer import get_course_directly
-            course_list = []
-            for cid in courses:
-                course_info = get_course_directly(cid)
-                course_list.append(f"• {format_course_label(cid, course_info.get('title', '') if course_info else '')}")
+            course_list = [f"• {format_course_label(c['id'], c.get('title', ''))}" for c in courses]
 
-            source_info = get_course_directly(course_id)
             source_str = format_course_label(course_id, source_info.get('title', '') if source_info else '')
 
             return {"answer": f"After completing {source_str}, you can take:\n\n" + "\n".join(course_list), "sources": []}
         return {"answer": f"No courses in the database list {course_id} as a prerequisite.", "sources": []}
+    return None
+
+
+def _discard_task(task):
+    """Cancel a background task whose result is no longer needed."""
+    task.cancel()
+    # Mark the outcome as seen so asyncio doesn't log "exception was never retrieved"
+    task.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+async def _prepare_answer_async(query, user_context=None):
+    """Run retrieval, routing and context assembly — everything except the LLM call.
+
+    Returns one of two shapes:
+      - {"answer": ..., "sources": [...]} when a deterministic handler already
+        answered the question (no LLM needed)
+      - {"messages": [...], "enriched_by_id": {...}, "sources": [...]} ready to
+        be sent to the LLM
+    """
+
+    # ── STEP 1: RETRIEVE ────────────────────────────────────────────────────
+    # hybrid_search() queries ChromaDB (vector similarity) and supplements the
+    # results with deterministic SQL logic (e.g. department filters, entry-level
+    # courses). It returns a list of dicts, each with at least a "course_id" key.
+    #
+    # We start it as a background task rather than awaiting it: query routing
+    # below is pure regex and handlers A/B don't need retrieval at all, so they
+    # can answer while the embedding + ANN search is still in flight. The
+    # comparison-program searches (Step 3) go out at the same time.
+    retrieval_task = asyncio.gather(
+        hybrid_search_async(query),
+        _retrieve_comparison_programs(query),
+    )
+
+    # ── STEP 2: QUERY ROUTING ───────────────────────────────────────────────
+    # For a handful of question shapes we can answer deterministically — no LLM
+    # needed. We check those here and return early if one matches.
+    # This is faster, cheaper, and avoids hallucinations for simple lookups.
+    query_type = detect_query_type(query)
+
+    # Extract the first course code mentioned in the query (e.g. "COMP 250")
+    # re.search scans the uppercased query for a DEPT + NUMBER pattern.
+    match = re.search(r'\b([A-Z]{3,4})[\s\-]?(\d{3}[A-Z]?)\b', query.upper())
+    course_id = f"{match.group(1)} {match.group(2)}" if match else ""
+
+    # Handlers A and B answer straight from the DB. If one fires, the retrieval
+    # started above isn't needed, so we cancel it and return right away. The same
+    # goes if a handler fails (e.g. a DB error): the task must not be left running.
+    try:
+        deterministic = await _answer_deterministically(query, query_type, match)
+    except BaseException:
+        _discard_task(retrieval_task)
+        raise
+    if deterministic is not None:
+        _discard_task(retrieval_task)
+        return deterministic
+
+    # Everything from here on needs the retrieval results
+    retrieved_docs, comparison_retrieved = await retrieval_task
 
     # ── HANDLER C: Ambiguous course title ───────────────────────────────────
     # hybrid_search flags this when multiple courses share the same title (e.g.
@@ -292,9 +526,8 @@ def generate_answer(query, user_context=None):
         alternatives = retrieved_docs[0].get("alternatives", [])
         if alternatives:
             alt_info = []
-            for alt_id in alternatives:
-                from rag_layer import get_course_directly
-                alt_course = get_course_directly(alt_id)
+            alt_courses = await asyncio.gather(*(get_course_directly_async(a) for a in alternatives))
+            for alt_id, alt_course in zip(alternatives, alt_courses):
                 if alt_course:
                     alt_info.append(f"- {alt_id} ({alt_course.get('title', 'Unknown')}) - {alt_course.get('department', 'Unknown')}")
                 else:
@@ -317,16 +550,14 @@ def generate_answer(query, user_context=None):
     #
     # - Course chunks are just IDs — we need to query PostgreSQL to get the title,
     #   credits, prereqs, etc. That happens in enrich_context() below.
-    from rag_layer import extract_all_course_ids, get_course_directly
+    from rag_layer import extract_all_course_ids
 
     program_texts = []    # full prose paragraphs from institutional program scrapes
     course_result_ids = []  # bare course IDs to be enriched from the DB
 
-    # For comparison queries ("difference between X and Y"), do two targeted program
-    # retrievals instead of using the single mixed search result. This ensures we fetch
-    # exactly the programs the student named, not whatever happens to rank highest overall.
-    comparison_retrieved = _retrieve_comparison_programs(query)
-
+    # For comparison queries ("difference between X and Y"), we did two targeted program
+    # retrievals in Step 1 instead of using the single mixed search result. This ensures we
+    # fetch exactly the programs the student named, not whatever happens to rank highest overall.
     if comparison_retrieved:
         # Use only the two targeted program chunks for the comparison
         for r in comparison_retrieved:
@@ -366,7 +597,17 @@ def generate_answer(query, user_context=None):
     # enrich_context() takes a list of course IDs and fetches their full details
     # from PostgreSQL: title, description, credits, prereqs, coreqs, offered terms.
     # This is what gets pasted into the [COURSES] section of the LLM prompt.
-    context_docs = enrich_context(course_result_ids)
+    #
+    # The program-prose codes for 4a are known already (they come from the
+    # retrieved text, not from the DB), so both lookups run at the same time.
+    program_course_ids = set()
+    for prog_text in program_texts:
+        program_course_ids.update(extract_all_course_ids(prog_text))
+    program_course_ids.difference_update(course_result_ids)
+    context_docs, program_course_docs = await asyncio.gather(
+        enrich_context_async(course_result_ids),
+        enrich_context_async(list(program_course_ids)) if program_course_ids else asyncio.sleep(0, result=[]),
+    )
 
     # 4a. EXPAND: fetch course details for every course mentioned in program prose.
     #
@@ -378,14 +619,10 @@ def generate_answer(query, user_context=None):
     # the DB stores course IDs as "MATH-318" (hyphen). We normalize here so the
     # DB lookup actually finds the row.
     existing_ids = set(d["id"] for d in context_docs)
-    program_course_ids = set()
-    for prog_text in program_texts:
-        for cid in extract_all_course_ids(prog_text):
-            # extract_all_course_ids returns "COMP 252" (space), which matches the DB format
-            if cid not in existing_ids:
-                program_course_ids.add(cid)
-    if program_course_ids:
-        program_course_docs = enrich_context(list(program_course_ids))
+    # extract_all_course_ids returns "COMP 252" (space), which matches the DB format.
+    # Drop anything the main lookup already returned so no course appears twice.
+    program_course_docs = [d for d in program_course_docs if d["id"] not in existing_ids]
+    if program_course_docs:
         context_docs.extend(program_course_docs)
         existing_ids.update(d["id"] for d in program_course_docs)
 
@@ -428,7 +665,7 @@ def generate_answer(query, user_context=None):
                         if cid not in existing_ids:
                             extra_ids.add(cid)
         if extra_ids:
-            extra_docs = enrich_context(list(extra_ids))
+            extra_docs = await enrich_context_async(list(extra_ids))
             context_docs.extend(extra_docs)
 
     # ── STEP 5: ASSEMBLE THE CONTEXT STRING ─────────────────────────────────
@@ -436,25 +673,11 @@ def generate_answer(query, user_context=None):
     # prompt. The LLM is instructed to answer ONLY from this context — not from
     # its training knowledge. This prevents hallucination.
 
-    def format_offering(d):
-        """Format the offering terms for a course (e.g. 'Fall, Winter')."""
-        terms = []
-        if d.get('offered_fall'):
-            terms.append('Fall')
-        if d.get('offered_winter'):
-            terms.append('Winter')
-        if d.get('offered_summer'):
-            terms.append('Summer')
-        return ', '.join(terms) if terms else 'Not specified'
-
-    # Each course becomes one readable block. format_course_label strips placeholder
-    # titles so a course with no real title appears as just "COMP 314" (no parenthetical).
+    # Only the top few directly-retrieved courses (the ones the question is most
+    # likely about) keep their full description — see format_course() above.
+    full_description_ids = set(direct_course_source_ids[:FULL_DESCRIPTION_TOP_K])
     course_context = "\n\n".join(
-        f"{format_course_label(d['id'], d.get('title', ''))} - {d['credits']} credits, {d['department']}\n"
-        f"Description: {d['description'] if d.get('description') and d['description'] != 'N/A' else 'No description available.'}\n"
-        f"Prereqs: {d['prereqs'] or 'None'}\n"
-        f"Coreqs: {d['coreqs'] or 'None'}\n"
-        f"Offered: {format_offering(d)}"
+        format_course(d, full_description=d['id'] in full_description_ids)
         for d in context_docs
     )
 
@@ -470,130 +693,35 @@ def generate_answer(query, user_context=None):
         context = course_context
 
     # ── STEP 6: BUILD THE PROMPT ─────────────────────────────────────────────
-    # The prompt is a single big f-string that tells the LLM:
-    #   - Who it is (McGill assistant)
-    #   - The rules it must follow (use only context, be concise, etc.)
-    #   - Common student phrasings to watch out for
-    #   - The student's question
-    #   - The context we assembled above
-    #
-    # Prompt engineering is iterative — these rules were added one by one as the
-    # LLM got things wrong in testing. Each rule is a lesson learned.
-    prompt = f"""You are a helpful academic assistant for McGill University. Use "I" naturally, keep it casual and conversational.
-Use only the context below to answer the student's question.
-
-[COMMON COURSE NICKNAMES]
-Students often use nicknames for courses. Here are the mappings:
-- "Calc 1" / "Calculus 1" = MATH 140
-- "Calc 2" / "Calculus 2" = MATH 141
-- "Calc 3" / "Calculus 3" = MATH 222
-- "Linear Algebra" / "Lin Alg" = MATH 133
-- "Discrete Math" / "Discrete" = MATH 240
-- "ODE" = MATH 323
-- "PDE" = MATH 324
-- "Real Analysis" = MATH 242
-- "Intro to CS" / "Intro CS" = COMP 202
-- "Data Structures" = COMP 250
-- "Algorithms" = COMP 251
-- "Operating Systems" / "OS" = COMP 310
-- "Databases" = COMP 421
-- "AI" = COMP 424
-- "Machine Learning" / "ML" = COMP 551
-- "Compilers" = COMP 520
-- "Computer Graphics" / "Graphics" = COMP 557
-
-When a student uses a nickname, treat it as the corresponding course code.
-
-[UNDERSTANDING STUDENT QUESTIONS]
-Students ask about prerequisites in different ways. These mean the SAME thing:
-- "What are the prerequisites for X?" = "What do I need before X?" = "What's required for X?"
-- "Which courses require X?" = "What can I take after X?" = "What courses need X?" = "I finished X, what's next?"
-
-[CRITICAL RULES]
-- Use ONLY the context provided — do NOT make up information.
-- If the context doesn't contain the answer, say "I don't have enough information to answer that."
-- When listing courses, include ALL matches from the context.
-- For prerequisite questions: look at the "Prereqs:" field of the course asked about.
-- For "what requires X" questions: look for courses where X appears in their "Prereqs:" field.
-- If doesn't have description available, instead of saying "No description available." say "The course exists in the database but I can't find it's description. Please check the [McGill eCalendar](https://www.mcgill.ca/study/2024-2025/courses/{course_id.replace(' ', '-').lower()}) directly."
-
-**RESPONSE FORMAT:**
-- Course titles are already embedded in the context next to their codes, like "COMP 252 (Honours Algorithms and Data Structures)". Always include the title in parentheses when writing a course — copy it exactly as it appears in the context.
-- If a course code appears with no parenthetical title anywhere in the context, list it by code only. Never invent or guess a title.
-- When listing prerequisites, format as: "Prerequisites: COMP 202 (Foundations of Programming)"
-- When describing program requirements, ALWAYS mention both required courses AND complementary/elective courses if both are listed in the context.
-- Be concise. Answer the question directly — never repeat information, never list the same course twice, never add context the student didn't ask for.
-- **COMPARISON QUESTIONS:** When asked what's different or extra between two programs:
-  - First, identify which two programs the student named in their question. ONLY compare those two. Ignore all other programs in the context, even if they look similar.
-  - Reason through the comparison INTERNALLY. Do NOT list both programs' courses in your answer — students don't need to see the intermediate work, only the final result.
-  - Only output the courses that are exclusively in one program and not the other.
-  - Pay attention to direction. "What extra does Honours require compared to Major?" means: courses in Honours that are NOT in Major. Do NOT include courses that are only in the Major — those are not extra requirements for Honours.
-  - A course that appears in BOTH programs is shared and must not appear in the differences.
-  - If two programs each require a different version of a related course (e.g. Honours has COMP 252 while Major has COMP 251), say "COMP 252 instead of COMP 251" rather than listing each as a separate difference.
-
-**TIMING & YEAR QUESTIONS:**
-When a student asks "should I take X in first year or second year?" or "when should I take X?":
-- Look at the course's prerequisites and corequisites
-- Think about when those prereqs are typically completed (100-level = first year, 200-level = second year, etc.)
-- Give a specific recommendation based on the prereq chain, e.g.: "COMP 307 requires COMP 206 and COMP 250, which are typically first-year courses. So second year is the earliest you could take it."
-- Do NOT list unrelated entry-level courses. Focus on the specific course asked about.
-
-**IMPORTANT RULES FOR COREQUISITES:**
-A corequisite is a course that must be taken concurrently with OR may have been taken prior to another course.
-
-This means:
-- If Course A is a corequisite for Course B, a student can take B if they:
-  1. Take A at the SAME TIME as B, OR
-  2. Have ALREADY completed A in a previous semester
-
-- Corequisites are NOT prerequisites. A student does NOT need to complete the corequisite before taking the course.
-
-**Example:**
-- COMP 273 has COMP 206 as a corequisite (not a prerequisite)
-- This means: You can take COMP 273 if you're taking COMP 206 at the same time, OR if you've already completed COMP 206
-- You do NOT need to finish COMP 206 before starting COMP 273
-
-{f"{user_context}" + chr(10) + chr(10) if user_context else ""}Question: {query}
-Context:
-{context}
-Answer clearly and concisely:
-"""
+    # The prompt is split into two chat messages:
+    #   - SYSTEM_PROMPT (module level): who the LLM is and the rules it must
+    #     follow. Identical on every call, so OpenAI's prompt cache serves it and
+    #     we don't pay full price/latency for those tokens each time.
+    #   - The human message: everything that changes per question — the student
+    #     profile, the question, the context we assembled above.
+    course_link = f"https://www.mcgill.ca/study/2024-2025/courses/{course_id.replace(' ', '-').lower()}"
+    user_message = (
+        (f"{user_context}\n\n" if user_context else "")
+        + f"Question: {query}\n"
+        + f"Context:\n{context}\n"
+        + "[eCALENDAR NOTE] If a course doesn't have a description available, say \"The course exists in the database "
+        + f"but I can't find it's description. Please check the [McGill eCalendar]({course_link}) directly.\"\n"
+        + "Answer clearly and concisely:\n"
+    )
+    messages = [SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=user_message)]
 
     # Build this lookup now — needed for both title injection (Step 7b) and sources (Step 8).
     # Maps "COMP-252" → {id, title, prereqs, ...} so we can look up any course by DB id.
     enriched_by_id = {d["id"]: d for d in context_docs}
 
-    # ── STEP 7: CALL THE LLM ────────────────────────────────────────────────
-    # llm.invoke() sends the prompt to GPT-4o-mini and blocks until we get a
-    # response. response.content is the answer string.
-    response = llm.invoke(prompt)
-
-    # ── STEP 7b: POST-PROCESS — INJECT COURSE TITLES ────────────────────────
-    # Even with the title injection into program prose, the LLM sometimes copies
-    # course codes without their titles. As a reliable fallback, we scan the
-    # answer for bare course codes (e.g. "COMP 252") and replace them with the
-    # full label ("COMP 252 (Honours Algorithms and Data Structures)") using the
-    # enriched_by_id map we already have. This runs purely in Python — no extra
-    # LLM call needed.
-    #
-    # The regex matches patterns like "COMP 252" or "MATH 340" that are NOT
-    # already followed by a parenthesis (so we don't double-wrap existing labels).
-    def inject_titles(text: str) -> str:
-        def replace_code(m):
-            dept, num = m.group(1), m.group(2)
-            db_id = f"{dept} {num}"           # "COMP 252" — DB uses spaces, not hyphens
-            d = enriched_by_id.get(db_id, {})
-            return format_course_label(db_id, d.get("title", ""))
-        return re.sub(r'\b([A-Z]{3,4}) (\d{3}[A-Z]?)\b(?!\s*\()', replace_code, text)
-
-    answer_text = inject_titles(response.content)
-
     # ── STEP 8: BUILD SOURCES FOR THE FRONTEND ──────────────────────────────
     # The frontend "thinking" header shows which courses and programs the system
     # searched. We deliberately show only the DIRECTLY-retrieved items — not the
     # hundreds of support docs fetched in Steps 4a/4b to fill in prereq chains.
     # Those are internal enrichment, not "sources" in the user-facing sense.
     #
+    # Sources don't depend on the LLM's answer, so we build them before the call.
+    #
     # Course sources: the IDs that came straight out of the vector search (saved
     #   as direct_course_source_ids before we expanded context above).
     # Program sources: the program chunks from retrieved_docs, capped at 5 so
@@ -626,7 +754,90 @@ Answer clearly and concisely:
             if len(seen_programs) >= 5:
                 break
 
-    return {"answer": answer_text, "sources": sources}
+    return {"messages": messages, "enriched_by_id": enriched_by_id, "sources": sources}
+
+
+async def _cancel_leftover_tasks():
+    pending = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _run_sync(coro):
+    """asyncio.run() for the blocking wrappers below, minus the wait on worker threads.
+
+    asyncio.run() ends by joining the loop's default executor, i.e. every
+    asyncio.to_thread() call still running. When handlers A/B answer, they cancel
+    the retrieval task, but cancelling can't stop the hybrid_search() thread behind
+    it, so asyncio.run() would sit there until the search finished anyway. Here
+    the loop is closed without that join: the abandoned thread finishes on its own
+    (its result still lands in the search cache) and the caller gets its answer now.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        try:
+            # Same cleanup as asyncio.run(): cancel whatever the coroutine left behind
+            loop.run_until_complete(_cancel_leftover_tasks())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()  # shuts the default executor down with wait=False
+
+
+def _prepare_answer(query, user_context=None):
+    """Blocking version of _prepare_answer_async() for sync callers (e.g. stream_answer)."""
+    return _run_sync(_prepare_answer_async(query, user_context))
+
+
+async def generate_answer_async(query, user_context=None):
+    """Answer a question in one go. Returns {"answer": str, "sources": list}."""
+    prepared = await _prepare_answer_async(query, user_context)
+    if "messages" not in prepared:
+        return prepared  # a deterministic handler already answered
+
+    # ── STEP 7: CALL THE LLM ────────────────────────────────────────────────
+    # llm.ainvoke() sends the messages to GPT-4o-mini and awaits the response
+    # without holding a thread. response.content is the answer string.
+    response = await llm.ainvoke(prepared["messages"])
+
+    # ── STEP 7b: POST-PROCESS — INJECT COURSE TITLES ────────────────────────
+    answer_text = inject_titles(response.content, prepared["enriched_by_id"])
+    return {"answer": answer_text, "sources": prepared["sources"]}
+
+
+def generate_answer(query, user_context=None):
+    """Blocking version of generate_answer_async(), kept for scripts and sync callers."""
+    return _run_sync(generate_answer_async(query, user_context))
+
+
+def stream_answer(query, user_context=None):
+    """Answer a question as a generator of text pieces.
+
+    llm.stream() yields tokens as GPT-4o-mini produces them, instead of
+    llm.invoke() blocking until the full answer exists. Deterministic answers
+    (prereq checks, "what can I take after X", clarifications) are yielded as a
+    single piece so callers can treat every answer the same way.
+
+    Title injection (Step 7b) needs whole course codes, and a token boundary can
+    split "COMP 2" / "52". So we hold text back until a newline arrives and
+    post-process complete lines only.
+    """
+    prepared = _prepare_answer(query, user_context)
+    if "messages" not in prepared:
+        yield prepared["answer"]
+        return
+
+    enriched_by_id = prepared["enriched_by_id"]
+    pending = ""
+    for chunk in llm.stream(prepared["messages"]):
+        pending += chunk.content
+        if "\n" in pending:
+            complete, pending = pending.rsplit("\n", 1)
+            yield inject_titles(complete + "\n", enriched_by_id)
+    if pending:
+        yield inject_titles(pending, enriched_by_id)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -634,4 +845,6 @@ Answer clearly and concisely:
 # Usage: cd backend && python3 qa_agent.py
 # ─────────────────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
-    print(generate_answer("Which courses require COMP 250?"))
+    for piece in stream_answer("Which courses require COMP 250?"):
+        print(piece, end="", flush=True)
+    print()
@@ -1,17 +1,265 @@
 # rag_layer.py
-import json
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import os
 import pathlib
+import pickle
+import platform
 import re
+import sys
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional
-import chromadb
-from chromadb.utils import embedding_functions
+import orjson
+from sqlalchemy import func, select
 from db_connection import Session as DBSession
 from db_setup import Course
-from deterministic_logic import get_courses_requiring
+from deterministic_logic import COURSE_DICT_COLUMNS, course_to_dict, get_courses_requiring_enriched
 
 # Path to the institutional knowledge JSON files scraped from the course catalogue
 INSTITUTIONAL_DATA_DIR = pathlib.Path(__file__).parent / "institutional_data" / "programs"
 
+# ChromaDB settings shared by the build and search paths.
+#
+# MiniLM is used with cosine similarity. If the vectors are already unit-length,
+# cosine IS the dot product, so we ask SentenceTransformers to L2-normalize every
+# embedding (documents at build time, queries at search time) and configure the
+# HNSW index for inner product ("ip"). Each distance is then a single dot product
+# — the cheapest SIMD kernel HNSW has — with no per-query normalization step.
+# Ranking is identical to cosine; Chroma reports distance = 1 - dot.
+CHROMA_PATH = "./chroma_db"
+COLLECTION_NAME = "courses_collection"
+COLLECTION_METADATA = {"hnsw:space": "ip"}
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+
+# Which runtime runs MiniLM. ONNX Runtime with the INT8-quantized weights that ship
+# in the model repo is several times faster than FP32 PyTorch on CPU (and uses
+# VNNI int8 dot-product instructions where the CPU has them). "openvino" is an
+# option on Intel hosts; "torch" restores the original behaviour.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+# Quantized ONNX file inside the all-MiniLM-L6-v2 repo, picked per CPU family
+_DEFAULT_ONNX_FILE = (
+    "onnx/model_qint8_arm64.onnx" if platform.machine().lower() in ("arm64", "aarch64")
+    else "onnx/model_qint8_avx512_vnni.onnx"
+)
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", _DEFAULT_ONNX_FILE)
+
+# Precision for the PyTorch backend (used with EMBEDDING_BACKEND=torch, or as the
+# fallback). Half-precision weights halve the memory traffic of every forward pass
+# and MiniLM's embeddings barely move: "auto" picks float16 on a CUDA GPU and
+# bfloat16 on CPUs with native BF16 dot products (AVX512-BF16 / AMX, e.g.
+# Sapphire Rapids, Zen 4), and keeps float32 everywhere else. "qint8" is opt-in:
+# the model loads in float32 and its Linear layers are dynamically quantized to
+# int8 (weights stored as int8, activations quantized on the fly) — the
+# PyTorch-side equivalent of the INT8 ONNX export, for when onnxruntime isn't
+# available. It's never picked automatically: the stored index may have been
+# built on another host or backend, and int8 query vectors searched against it
+# haven't been measured. After switching to it, rebuild the vector store so the
+# course and query vectors come from the same model. Set to
+# "float32", "float16", "bfloat16" or "qint8" to force one. Vectors come back
+# (and are stored) as float32.
+EMBEDDING_TORCH_DTYPE = os.getenv("EMBEDDING_TORCH_DTYPE", "auto")
+
+
+def _cpu_has_bf16() -> bool:
+    """True if /proc/cpuinfo advertises native BF16 instructions (Linux only)."""
+    try:
+        cpuinfo = pathlib.Path("/proc/cpuinfo").read_text()
+    except OSError:
+        return False
+    return "avx512_bf16" in cpuinfo or "amx_bf16" in cpuinfo
+
+
+def _torch_dtype_name() -> str:
+    """Resolve EMBEDDING_TORCH_DTYPE ("auto" → float16 / bfloat16 / float32 for this host)."""
+    import torch
+
+    if EMBEDDING_TORCH_DTYPE != "auto":
+        return EMBEDDING_TORCH_DTYPE
+    if torch.cuda.is_available():
+        return "float16"
+    if _cpu_has_bf16():
+        return "bfloat16"
+    return "float32"
+
+
+def _load_torch_model(model_name: str):
+    """Load a PyTorch SentenceTransformer at the precision chosen by EMBEDDING_TORCH_DTYPE."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    dtype_name = _torch_dtype_name()
+    if dtype_name != "qint8":
+        return SentenceTransformer(model_name, model_kwargs={"torch_dtype": getattr(torch, dtype_name)})
+
+    # Dynamic quantization only has CPU kernels, so the model stays on the CPU
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0]  # the Transformer module wrapping the Hugging Face model
+    transformer.auto_model = torch.ao.quantization.quantize_dynamic(
+        transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return model
+
+
+# chromadb and sentence_transformers (which drags in torch/onnxruntime, transformers,
+# tokenizers, protobuf) take a second or more to import. Code paths that never touch
+# the vector store — extract_course_id, get_course_directly, enrich_context, CLI
+# tools like reset_db.py — shouldn't pay that, so both are imported on first use of
+# the collection rather than at module import.
+def _import_chroma():
+    """Import chromadb on first use (cached by Python's module table afterwards)."""
+    import chromadb
+    return chromadb
+
+
+# Query embeddings are cached inside the embedding function, one level below the
+# search-result LRU. The same text often comes back with different search
+# parameters (another n_results or department filter, a result-cache entry that
+# was evicted or invalidated by a rebuild) and its vector hasn't changed, so the
+# transformer forward pass is skipped and only the HNSW probe runs again.
+# Document vectors for the build go through encode() and bypass this cache.
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+
+
+@functools.lru_cache(maxsize=None)
+def _embedding_function_class():
+    """Define MiniLMEmbeddingFunction once chromadb's base class has been imported."""
+    from chromadb.api.types import EmbeddingFunction
+
+    class MiniLMEmbeddingFunction(EmbeddingFunction):
+        """Chroma embedding function around a SentenceTransformer on the ONNX/INT8 backend.
+
+        Chroma's built-in SentenceTransformerEmbeddingFunction always loads the
+        PyTorch FP32 model. This one asks SentenceTransformers for the quantized ONNX
+        export instead, and falls back to PyTorch if onnxruntime (or the file) isn't
+        available, so a missing extra never breaks search.
+        """
+
+        def __init__(self, model_name: str = EMBEDDING_MODEL, backend: str = EMBEDDING_BACKEND):
+            from sentence_transformers import SentenceTransformer
+
+            try:
+                if backend == "onnx":
+                    self._model = SentenceTransformer(model_name, backend="onnx", model_kwargs={"file_name": EMBEDDING_ONNX_FILE})
+                elif backend == "openvino":
+                    self._model = SentenceTransformer(model_name, backend="openvino")
+                else:
+                    self._model = _load_torch_model(model_name)
+            except Exception as e:
+                print(f"[EMBED] {backend} backend unavailable ({e}), falling back to PyTorch")
+                self._model = _load_torch_model(model_name)
+
+            # LRU of text → embedding row (see QUERY_EMBEDDING_CACHE_SIZE)
+            self._vector_cache: "OrderedDict[str, object]" = OrderedDict()
+            self._vector_cache_lock = threading.Lock()
+
+        def __call__(self, input):
+            """Embed texts, running the model only for texts not embedded recently."""
+            texts = list(input)
+            vectors = [None] * len(texts)
+            with self._vector_cache_lock:
+                for i, text in enumerate(texts):
+                    vector = self._vector_cache.get(text)
+                    if vector is not None:
+                        self._vector_cache.move_to_end(text)
+                        vectors[i] = vector
+
+            missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+            if missing:
+                # One forward pass for every miss, then backfill the cache
+                fresh = dict(zip(missing, self.encode(missing)))
+                with self._vector_cache_lock:
+                    for text, vector in fresh.items():
+                        self._vector_cache[text] = vector
+                        self._vector_cache.move_to_end(text)
+                    while len(self._vector_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                        self._vector_cache.popitem(last=False)
+                vectors = [fresh[t] if v is None else v for t, v in zip(texts, vectors)]
+
+            # Unit-length vectors, so the "ip" index distance is cosine distance
+            return [v.tolist() for v in vectors]
+
+        def encode(self, texts: list[str], batch_size: int = 64, show_progress_bar: bool = False):
+            """Encode texts into a (len(texts), 384) numpy array of unit-length vectors."""
+            return self._model.encode(
+                texts,
+                batch_size=batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=show_progress_bar,
+            )
+
+    return MiniLMEmbeddingFunction
+
+
+def _make_embedding_fn():
+    """MiniLM embedding function that emits L2-normalized vectors."""
+    return _embedding_function_class()()
+
+
+# Chroma handles, created once per process and reused by every build and search.
+# Loading the MiniLM weights takes hundreds of ms to seconds, and every
+# PersistentClient opens its own sqlite connection — neither belongs on the
+# per-query path. The lock makes sure two threads racing on the first call
+# don't each load a copy of the model.
+_client = None
+_embedding_fn = None
+_collection = None
+_chroma_lock = threading.Lock()
+
+
+def _get_collection():
+    """Return the shared collection, creating the client/model/collection on first use."""
+    global _client, _embedding_fn, _collection
+    if _collection is None:
+        with _chroma_lock:
+            if _collection is None:
+                _client = _import_chroma().PersistentClient(path=CHROMA_PATH)
+                _embedding_fn = _make_embedding_fn()
+                _collection = _client.get_or_create_collection(
+                    name=COLLECTION_NAME,
+                    embedding_function=_embedding_fn,
+                    metadata=COLLECTION_METADATA,
+                )
+    return _collection
+
+
+def _get_embedding_fn():
+    """Return the shared (normalized) MiniLM embedding function."""
+    _get_collection()
+    return _embedding_fn
+
+
+def warm_up():
+    """Load the model and in-memory tables now, so the first search doesn't pay for it.
+
+    The first encode() call is much slower than the rest (the runtime sets up its
+    buffers on first use), so one throwaway sentence is embedded too. It goes
+    through encode(), which bypasses the query-vector cache.
+    """
+    _get_embedding_fn().encode(["warm up"])
+    _load_title_cache()  # also loads the course table it's built from
+
+
+def _recreate_collection():
+    """Drop the collection and create it again with the current COLLECTION_METADATA."""
+    global _collection
+    _get_collection()
+    with _chroma_lock:
+        _client.delete_collection(name=COLLECTION_NAME)
+        _collection = _client.create_collection(
+            name=COLLECTION_NAME,
+            embedding_function=_embedding_fn,
+            metadata=COLLECTION_METADATA,
+        )
+    return _collection
+
+
 # Import LLM for query understanding (will be set by qa_agent)
 _llm = None
 
@@ -23,24 +271,38 @@ def set_llm(llm_instance):
 
 
 # Step 1️⃣ — Load courses from DB
+_COURSE_NUMBER_RE = re.compile(r'\d{3}')  # "COMP 250" → 250, for the level metadata
+
+
 def load_course_docs():
-    """Extracts all course information from the database and prepares it for vectorization."""
+    """Yield every course from the database, prepared for vectorization (one dict per course)."""
+    # Select plain tuples instead of Course objects (no ORM hydration or identity-map
+    # bookkeeping) and let Postgres build the embedding text. concat_ws skips NULLs;
+    # NULLIF turns empty strings into NULLs too, so missing fields don't leave
+    # double spaces — same result as the old " ".join(filter(None, ...)).
+    text_expr = func.concat_ws(
+        " ",
+        func.nullif(Course.title, ""),
+        func.nullif(Course.description, ""),
+        func.nullif(Course.prereq_text, ""),
+        func.nullif(Course.coreq_text, ""),
+    ).label("text")
+    # Department code is the part of the ID before the space ("COMP 250" → "COMP");
+    # split_part does that in the same projection instead of a Python split per row.
+    stmt = select(Course.id, Course.title, text_expr, func.split_part(Course.id, " ", 1).label("department"))
+
+    # yield_per streams rows from a server-side cursor 512 at a time, so the whole
+    # catalogue is never held in memory at once — the caller embeds and stores
+    # each window before the next one is read.
     with DBSession() as session:
-        courses = session.query(Course).all()
-        documents = []
-        for course in courses:
-            text = " ".join(filter(None, [
-                course.title or "",
-                course.description or "",
-                course.prereq_text or "",
-                course.coreq_text or ""
-            ]))
+        for course in session.execute(stmt.execution_options(yield_per=512)):
+            text = course.text or ""
 
             # Infer course level from the number in the course ID (e.g. "COMP 250" → 250 → upper)
             # This metadata lets the LLM reason about year/difficulty without hardcoding anything.
             level = "unknown"
             if course.id:
-                num_match = re.search(r'\d{3}', course.id)
+                num_match = _COURSE_NUMBER_RE.search(course.id)
                 if num_match:
                     num = int(num_match.group())
                     if num < 300:
@@ -50,14 +312,13 @@ def load_course_docs():
                     else:
                         level = "graduate"   # 500+: grad level
 
-            documents.append({
+            yield {
                 "id": course.id,
                 "text": text,
                 "title": course.title,
-                "department": (course.id.split()[0] if course.id else None),
+                "department": course.department or None,
                 "level": level,
-            })
-        return documents
+            }
 
 
 def load_institutional_docs() -> list[dict]:
@@ -75,8 +336,8 @@ def load_institutional_docs() -> list[dict]:
     docs = []
     for json_file in sorted(INSTITUTIONAL_DATA_DIR.glob("*.json")):
         try:
-            with open(json_file) as f:
-                prog = json.load(f)
+            with open(json_file, "rb") as f:
+                prog = orjson.loads(f.read())
         except Exception:
             continue
 
@@ -136,71 +397,105 @@ def build_vector_store():
     about program requirements ("what does the CS major require?"); course chunks win
     for course-specific queries ("what is COMP 302 about?").
     """
-    client = chromadb.PersistentClient(path="./chroma_db")
-    embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-    collection = client.get_or_create_collection(
-        name="courses_collection",
-        embedding_function=embedding_fn
-    )
+    collection = _get_collection()
+
+    # A collection's distance metric is fixed when it's created. Older stores were
+    # built with Chroma's default (l2); since this function re-embeds everything
+    # anyway, drop such a collection and recreate it as an inner-product index.
+    if (collection.metadata or {}).get("hnsw:space") != COLLECTION_METADATA["hnsw:space"]:
+        print(f"Recreating '{COLLECTION_NAME}' with hnsw:space={COLLECTION_METADATA['hnsw:space']}")
+        collection = _recreate_collection()
+
+    # Documents flow through in windows: read up to BUILD_WINDOW_SIZE docs, embed
+    # them, upsert them, then read the next window. Peak memory is one window of
+    # text + vectors instead of the whole corpus several times over (docs list,
+    # ids/texts/metadatas lists, embedding matrix).
+    docs = _iter_index_docs()
+    n_courses = n_programs = 0
+    completed = True
+    while True:
+        window = list(itertools.islice(docs, BUILD_WINDOW_SIZE))
+        if not window:
+            break
+        if not _upsert_window(collection, window):
+            completed = False
+            break  # a bad document was reported; stop like the one-by-one fallback always has
+        for d in window:
+            if d["metadata"]["type"] == "course":
+                n_courses += 1
+            else:
+                n_programs += 1
+        print(f"  indexed {n_courses + n_programs} documents so far...")
+
+    if completed and not (n_courses or n_programs):
+        print("No valid documents to index. Exiting.")
+        return
+
+    # Even a partial build changed the index, so drop cached search results. The
+    # build just re-read the courses table, so pick up any changes in RAM too.
+    invalidate_search_cache()
+    refresh_course_cache()
+    if completed:
+        print(f"✅ Chroma vector store built with {n_courses + n_programs} documents "
+              f"({n_courses} courses + {n_programs} program chunks)")
+    else:
+        print(f"Build stopped early after {n_courses + n_programs} documents — see the error above.")
 
+
+# How many documents build_vector_store() reads, embeds and upserts at a time
+BUILD_WINDOW_SIZE = 5000
+
+
+def _iter_index_docs():
+    """Yield every document to index: cleaned course chunks, then program chunks."""
     # ── Course documents (from PostgreSQL) ───────────────────────────────────
-    raw_course_docs = load_course_docs() or []
+    # courses.id is the primary key, so duplicates can only come from IDs that
+    # differ by surrounding whitespace. A rolling set (rather than building a
+    # dict of the whole corpus) keeps this streaming; first occurrence wins.
     seen = set()
-    course_docs = []
-    for d in raw_course_docs:
-        _id = d.get("id")
-        if _id is None:
-            continue
-        _id = str(_id).strip()
+    seen_add = seen.add
+    for d in load_course_docs():
+        _id = str(d.get("id") or "").strip()
         if not _id or _id in seen:
             continue
-        seen.add(_id)
-        course_docs.append({
+        seen_add(_id)
+        yield {
             "id": _id,
             "text": str(d.get("text", "")),
             "metadata": {
                 "type": "course",
-                "title": str(d.get("title", "") or ""),
-                "department": str(d.get("department", "") or ""),
+                "title": str(d.get("title") or ""),
+                "department": str(d.get("department") or ""),
                 "level": str(d.get("level", "unknown")),
             }
-        })
+        }
 
     # ── Institutional program documents (from JSON files) ────────────────────
     # These are loaded from institutional_data/programs/*.json, scraped from the
     # McGill course catalogue. Each file is one major/honours program.
-    inst_docs = load_institutional_docs()
-
-    all_docs = course_docs + inst_docs
-    ids = [d["id"] for d in all_docs]
-    texts = [d["text"] for d in all_docs]
-    metadatas = [d["metadata"] for d in all_docs]
+    yield from load_institutional_docs()
 
-    print(f"Preparing to index {len(ids)} documents "
-          f"({len(course_docs)} courses + {len(inst_docs)} program chunks)")
 
-    if not ids:
-        print("No valid documents to index. Exiting.")
-        return
+def _upsert_window(collection, window: list[dict]) -> bool:
+    """Embed one window of documents and upsert it. Returns False if a document failed."""
+    ids = [d["id"] for d in window]
+    texts = [d["text"] for d in window]
+    metadatas = [d["metadata"] for d in window]
 
-    if not (len(ids) == len(texts) == len(metadatas)):
-        print("Length mismatch after cleaning — aborting.")
-        return
+    # Embed the window in ONE encode call instead of letting Chroma call the
+    # embedding function in its own small batches. SentenceTransformers sorts the
+    # texts it is given by length before batching, so each forward batch holds
+    # similar-length docs and pads far less (course texts range from a one-line
+    # title to multi-paragraph descriptions).
+    embeddings = _get_embedding_fn().encode(texts, batch_size=128, show_progress_bar=True)
 
     # Use upsert so this function is safe to re-run without deleting the existing DB.
     # upsert = update if exists, insert if not. Existing course embeddings are re-computed
     # (same text → same vectors) but the metadata gets the new `type` and `level` fields.
+    # We pass the precomputed embeddings, so Chroma stores them without re-embedding.
     try:
-        batch_size = min(5000, len(ids))
-        for i in range(0, len(ids), batch_size):
-            collection.upsert(
-                ids=ids[i:i+batch_size],
-                documents=texts[i:i+batch_size],
-                metadatas=metadatas[i:i+batch_size],
-            )
-        print(f"✅ Chroma vector store built with {len(ids)} documents "
-              f"({len(course_docs)} courses + {len(inst_docs)} program chunks)")
-        return
+        collection.upsert(ids=ids, documents=texts, metadatas=metadatas, embeddings=embeddings.tolist())
+        return True
     except Exception:
         import traceback
         print("Upsert failed, falling back to per-document upsert to locate bad entries.")
@@ -209,14 +504,14 @@ def build_vector_store():
     # Fallback: upsert one-by-one to find the problem document
     for idx, (_id, txt, meta) in enumerate(zip(ids, texts, metadatas)):
         try:
-            collection.upsert(ids=[_id], documents=[txt], metadatas=[meta])
+            collection.upsert(ids=[_id], documents=[txt], metadatas=[meta], embeddings=[embeddings[idx].tolist()])
         except Exception:
             print(f"❌ Failed to upsert document at index {idx}, id={_id!r}")
             import traceback
             traceback.print_exc()
-            break
-    else:
-        print("✅ All documents upserted individually (fallback succeeded).")
+            return False
+    print("✅ All documents upserted individually (fallback succeeded).")
+    return True
 
 
 def add_institutional_to_vector_store():
@@ -228,14 +523,7 @@ def add_institutional_to_vector_store():
 
     Safe to re-run: already-indexed program chunks are skipped via upsert.
     """
-    client = chromadb.PersistentClient(path="./chroma_db")
-    embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
-    collection = client.get_or_create_collection(
-        name="courses_collection",
-        embedding_function=embedding_fn,
-    )
+    collection = _get_collection()
 
     inst_docs = load_institutional_docs()
     if not inst_docs:
@@ -252,12 +540,17 @@ def add_institutional_to_vector_store():
     try:
         batch_size = min(500, len(ids))
         for i in range(0, len(ids), batch_size):
+            # Embedded here, as in _upsert_window(): if Chroma called the embedding
+            # function itself, program chunks would fill the query-vector cache
+            embeddings = _get_embedding_fn().encode(texts[i:i+batch_size], batch_size=128)
             collection.upsert(
                 ids=ids[i:i+batch_size],
                 documents=texts[i:i+batch_size],
                 metadatas=metadatas[i:i+batch_size],
+                embeddings=embeddings.tolist(),
             )
         total = collection.count()
+        invalidate_search_cache()
         print(f"✅ Done. ChromaDB now has {total} total documents "
               f"({total - len(ids)} courses + {len(ids)} program chunks).")
     except Exception:
@@ -265,37 +558,40 @@ def add_institutional_to_vector_store():
         traceback.print_exc()
 
 # Step 3️⃣ — Semantic search to find similar courses (and program chunks)
-def semantic_search(query: str, n_results: int = 5):
-    """Query ChromaDB and return the top-N most semantically similar chunks.
+
+# Dynamic request batching for semantic search.
+#
+# Every semantic search costs one transformer forward pass (embedding the query)
+# plus one HNSW traversal inside Chroma. When several students ask questions at
+# the same moment, doing that work once per query wastes most of it: the model
+# weights get loaded through the CPU caches once per query instead of once per
+# batch. So instead of searching immediately, each query waits a few ms in a
+# queue; whatever has piled up by then is embedded in ONE encode call and sent to
+# Chroma in ONE query call, and each caller gets its own slice of the results.
+# 32 matches one encode() mini-batch; a lone query waits at most 5ms for company.
+BATCH_MAX_SIZE = 32     # flush as soon as this many queries are waiting...
+BATCH_MAX_HOLD = 0.005  # ...or after 5ms, whichever comes first
+
+
+def _format_search_results(ids: list, distances: list, metadatas: list) -> list[dict]:
+    """Turn one query's slice of a Chroma result into our search-result dicts.
 
     The collection contains two kinds of documents:
     - Course chunks (id like "COMP 250"): regular course pages from the DB
     - Program chunks (id like "program::science_computer-science-major-bsc"):
       institutional knowledge scraped from the course catalogue
 
-    For course chunks, we return {"course_id": ..., "score": ...} as before.
-    For program chunks, we additionally include "program_text" so the caller
-    can inject it directly into the LLM context without a DB lookup.
-    """
-    client = chromadb.PersistentClient(path="./chroma_db")
-    embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-    collection = client.get_or_create_collection(
-        name="courses_collection",
-        embedding_function=embedding_fn
-    )
-
-    results = collection.query(
-        query_texts=[query],
-        n_results=n_results,
-        include=["distances", "metadatas"],  # ask Chroma to return metadata
-    )
+    Metadata comes back in the same collection.query() call as the distances
+    (include=["distances", "metadatas"]), so it's merged in here rather than
+    fetched with a second collection.get() round-trip.
 
+    For course chunks, we return {"course_id": ..., "score": ...} plus the
+    indexed "title" and "level". For program chunks, we additionally include
+    "program_text" so the caller can inject it directly into the LLM context
+    without a DB lookup.
+    """
     out = []
-    for id_, score, meta in zip(
-        results["ids"][0],
-        results["distances"][0],
-        results["metadatas"][0],
-    ):
+    for id_, score, meta in zip(ids, distances, metadatas):
         entry = {"course_id": id_, "score": float(score)}
 
         # If this is a program chunk, include its prose text and metadata so the
@@ -305,28 +601,304 @@ def semantic_search(query: str, n_results: int = 5):
             entry["program_name"] = meta.get("program", "")
             entry["program_faculty"] = meta.get("faculty", "")
             entry["program_url"] = meta.get("source_url", "")
+        elif meta:
+            # Course chunk: surface what we indexed so callers that only need a
+            # label don't have to go back to the course table. ("department" is
+            # left out on purpose — elsewhere that key means the offering unit.)
+            entry["title"] = meta.get("title", "")
+            entry["level"] = meta.get("level", "unknown")
 
         out.append(entry)
 
     return out
 
-# Helper function to use LLM to understand query intent and reformulate for better retrieval
-def understand_query_for_retrieval(query: str) -> dict:
-    """Use LLM to understand the query and reformulate it for semantic search.
-    
+
+class EmbeddingBatcher:
+    """Coalesce concurrent semantic searches into one embedding + one Chroma query.
+
+    The batcher runs its own asyncio event loop on a daemon thread. Callers hand it
+    a query and get back a future; the loop drains the queue into batches and
+    resolves each future with that caller's results.
+    """
+
+    def __init__(self, max_batch_size: int = BATCH_MAX_SIZE, max_batch_hold: float = BATCH_MAX_HOLD):
+        self.max_batch_size = max_batch_size
+        self.max_batch_hold = max_batch_hold
+        self._loop = None
+        self._queue = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Start the background event loop the first time a query arrives."""
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._queue = asyncio.Queue()
+                loop.create_task(self._run())
+                ready.set()
+                loop.run_forever()
+
+            threading.Thread(target=run, name="embedding-batcher", daemon=True).start()
+            ready.wait()
+            self._loop = loop
+
+    def submit(self, query: str, n_results: int, where: Optional[dict] = None):
+        """Queue a query from any thread. Returns a concurrent.futures.Future of its results."""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._enqueue(query, n_results, where), self._loop)
+
+    async def _enqueue(self, query: str, n_results: int, where: Optional[dict]):
+        future = self._loop.create_future()
+        await self._queue.put((query, n_results, where, future))
+        return await future
+
+    async def _run(self):
+        """Forever: wait for one query, then gather more until the batch is full or the hold expires."""
+        while True:
+            batch = [await self._queue.get()]
+            # Take whatever already piled up (e.g. during the previous encode) without
+            # waiting: wait_for() wraps every get() in its own task, get_nowait() doesn't
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            deadline = self._loop.time() + self.max_batch_hold
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Runs inline on the batcher thread. Queries that arrive while this batch
+            # is being encoded simply pile up and form the next batch.
+            self._flush(batch)
+
+    def _flush(self, batch: list):
+        try:
+            # Shared handles — the same normalized embedding fn as the build, so
+            # query vectors are unit-length too and "ip" distance equals cosine.
+            collection = _get_collection()
+            embedding_fn = _get_embedding_fn()
+            # One batched forward pass for every waiting query
+            vectors = embedding_fn([query for query, _, _, _ in batch])
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # A Chroma query takes a single `where` filter, so queries with different
+        # filters can share the embedding pass but not the ANN call. Group them.
+        groups: dict = {}
+        for i, (_, _, where, _) in enumerate(batch):
+            groups.setdefault(orjson.dumps(where, option=orjson.OPT_SORT_KEYS), []).append(i)
+
+        for members in groups.values():
+            where = batch[members[0]][2]
+            # One Chroma call serves the group, so ask for the largest n_results and slice per caller
+            n_results = max(batch[i][1] for i in members)
+            try:
+                results = collection.query(
+                    query_embeddings=[vectors[i] for i in members],
+                    n_results=n_results,
+                    where=where,
+                    include=["distances", "metadatas"],  # ask Chroma to return metadata
+                )
+            except Exception as e:
+                for i in members:
+                    if not batch[i][3].done():
+                        batch[i][3].set_exception(e)
+                continue
+
+            # Result slot j belongs to the j-th query in this group
+            for j, i in enumerate(members):
+                _, n, _, future = batch[i]
+                if future.done():
+                    continue
+                future.set_result(_format_search_results(
+                    results["ids"][j][:n],
+                    results["distances"][j][:n],
+                    results["metadatas"][j][:n],
+                ))
+
+
+_batcher = EmbeddingBatcher()
+
+
+# Semantic search result cache.
+#
+# Students (and the agent loop) repeat the same questions a lot. A repeated query
+# would otherwise pay a full MiniLM forward pass plus an HNSW probe to get back
+# the exact same list, so we keep the most recent SEARCH_CACHE_SIZE result lists
+# in an LRU keyed by (index version, normalized query, n_results, where).
+#
+# _index_version is bumped whenever the vector store is rebuilt, so results from
+# an old index can never be served — stale keys just age out of the LRU.
+SEARCH_CACHE_SIZE = 1024
+_search_cache: "OrderedDict[tuple, list[dict]]" = OrderedDict()
+_search_cache_lock = threading.Lock()
+_index_version = 0
+
+
+def _search_cache_key(query: str, n_results: int, where: Optional[dict]) -> tuple:
+    # orjson: the filter is serialized on every search, and it's ~10x faster than json.dumps
+    where_key = orjson.dumps(where, option=orjson.OPT_SORT_KEYS) if where else None
+    return (_index_version, query.strip().lower(), n_results, where_key)
+
+
+def _search_cache_get(key: tuple) -> Optional[list[dict]]:
+    """Return a copy of the cached results for key, or None on a miss."""
+    with _search_cache_lock:
+        results = _search_cache.get(key)
+        if results is None:
+            return None
+        _search_cache.move_to_end(key)
+    # Callers append to / edit the list they get back (hybrid_search does), so
+    # hand out copies and keep the cached entry pristine.
+    return [dict(r) for r in results]
+
+
+def _search_cache_put(key: tuple, results: list[dict]):
+    with _search_cache_lock:
+        _search_cache[key] = [dict(r) for r in results]
+        _search_cache.move_to_end(key)
+        while len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+
+
+def invalidate_search_cache():
+    """Forget every cached search result. Called after the vector store changes."""
+    global _index_version
+    with _search_cache_lock:
+        _index_version += 1
+        _search_cache.clear()
+
+
+async def semantic_search_async(query: str, n_results: int = 5, where: Optional[dict] = None):
+    """Query ChromaDB and return the top-N most semantically similar chunks (awaitable).
+
+    The query joins whatever other searches are in flight and is embedded with
+    them in one batch. See _format_search_results() for the shape of each result.
+    Repeated queries are answered from the in-process LRU without touching Chroma.
+
+    `where` is a Chroma metadata filter, e.g. {"department": "COMP"}. Chroma applies
+    it during the HNSW traversal, so we still get n_results matches after filtering
+    instead of filtering a top-N list down to fewer in Python.
+    """
+    key = _search_cache_key(query, n_results, where)
+    cached = _search_cache_get(key)
+    if cached is not None:
+        return cached
+    results = await asyncio.wrap_future(_batcher.submit(query, n_results, where))
+    _search_cache_put(key, results)
+    return results
+
+
+def semantic_search(query: str, n_results: int = 5, where: Optional[dict] = None):
+    """Blocking version of semantic_search_async() for the existing sync call sites."""
+    key = _search_cache_key(query, n_results, where)
+    cached = _search_cache_get(key)
+    if cached is not None:
+        return cached
+    results = _batcher.submit(query, n_results, where).result()
+    _search_cache_put(key, results)
+    return results
+
+
+def semantic_search_batch(queries: list[str], n_results: int = 5, where: Optional[dict] = None) -> list[list[dict]]:
+    """Search several queries at once; returns one result list per query, in order.
+
+    For callers that already hold a list of queries (multi-hop prompts, evals,
+    warm-up scripts). Cached queries are served from the LRU; every miss is
+    embedded in one forward pass and sent to Chroma in one query call, without
+    waiting on the batcher's hold window. Duplicates in `queries` are searched once.
+    """
+    keys = [_search_cache_key(q, n_results, where) for q in queries]
+    results = [_search_cache_get(k) for k in keys]
+
+    # One slot per distinct missing query (the key normalizes case/whitespace)
+    misses: dict = {}
+    for i, key in enumerate(keys):
+        if results[i] is None:
+            misses.setdefault(key, queries[i])
+
+    if misses:
+        collection = _get_collection()
+        vectors = _get_embedding_fn()(list(misses.values()))
+        batch = collection.query(
+            query_embeddings=vectors,
+            n_results=n_results,
+            where=where,
+            include=["distances", "metadatas"],
+        )
+        fresh = {}
+        for j, key in enumerate(misses):
+            fresh[key] = _format_search_results(batch["ids"][j], batch["distances"][j], batch["metadatas"][j])
+            _search_cache_put(key, fresh[key])
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = [dict(r) for r in fresh[key]]
+
+    return results
+
+# The LLM-based query understanding below costs a full chat-completion round-trip
+# (100–2000 ms). Course codes and the "what requires X" phrasing are already
+# recognised deterministically, so the LLM is only consulted for queries the
+# regex path can't classify — and only when explicitly switched on.
+USE_LLM_QUERY_UNDERSTANDING = os.getenv("USE_LLM_QUERY_UNDERSTANDING", "").lower() in ("1", "true", "yes")
+
+
+def understand_query_for_retrieval(query: str, use_llm: bool = USE_LLM_QUERY_UNDERSTANDING) -> dict:
+    """Work out how to search for a query, and reformulate it for semantic search.
+
     Returns a dict with:
     - reformulated_query: Better query for semantic search
-    - search_strategy: 'semantic' or 'prereq_lookup'
+    - search_strategy: 'semantic', 'general_search' or 'prereq_lookup'
     - course_code: Extracted course code if applicable
+
+    Regex first: if the query names a course we already know everything the LLM
+    would tell us. The LLM is a fallback for code-less queries, gated by
+    USE_LLM_QUERY_UNDERSTANDING (or use_llm=True) and memoized so a repeated
+    query costs one call.
     """
-    if not _llm:
-        # Fallback to original query if LLM not available
+    course_id, _ = extract_course_id(query)
+    if course_id:
+        query_lower = query.lower()
+        if _WHAT_REQUIRES_RE.search(query_lower) and "for" not in query_lower:
+            return {
+                "reformulated_query": f"courses with {course_id} as prerequisite",
+                "search_strategy": "prereq_lookup",
+                "course_code": course_id,
+            }
+        return {"reformulated_query": query, "search_strategy": "general_search", "course_code": course_id}
+
+    if not (_llm and use_llm):
+        # Fallback to original query if the LLM isn't available or isn't enabled
         return {
             "reformulated_query": query,
             "search_strategy": "semantic",
             "course_code": None
         }
-    
+    try:
+        return dict(_understand_query_with_llm(query))
+    except Exception as e:
+        # Fallback on error (failures aren't cached, so the next call retries)
+        print(f"LLM query understanding failed: {e}, using original query")
+        return {
+            "reformulated_query": query,
+            "search_strategy": "semantic",
+            "course_code": None
+        }
+
+
+@functools.lru_cache(maxsize=256)
+def _understand_query_with_llm(query: str) -> dict:
+    """Ask the LLM to classify and reformulate a query (one call per distinct query)."""
     understanding_prompt = f"""Analyze this query about McGill University courses and determine:
 1. What is the user really asking for?
 2. If asking "which courses require X", extract the course code X
@@ -350,36 +922,76 @@ Examples:
 
 JSON response only:"""
 
-    try:
-        response = _llm.invoke(understanding_prompt)
-        import json
-        # Try to extract JSON from response
-        content = response.content.strip()
-        # Remove markdown code blocks if present
-        if content.startswith("```"):
-            content = content.split("```")[1]
-            if content.startswith("json"):
-                content = content[4:]
-        content = content.strip()
-        
-        result = json.loads(content)
-        return {
-            "reformulated_query": result.get("reformulated_query", query),
-            "search_strategy": result.get("intent", "general_search"),
-            "course_code": result.get("course_code")
-        }
-    except Exception as e:
-        # Fallback on error
-        print(f"LLM query understanding failed: {e}, using original query")
-        return {
-            "reformulated_query": query,
-            "search_strategy": "semantic",
-            "course_code": None
-        }
-    
-
-
-_COURSE_ID_RE = re.compile(r'\b([A-Z]{3,4})[\s\-]?(\d{3}[A-Z]?)\b', re.IGNORECASE)
+    response = _llm.invoke(understanding_prompt)
+    # Try to extract JSON from response
+    content = response.content.strip()
+    # Remove markdown code blocks if present
+    if content.startswith("```"):
+        content = content.split("```")[1]
+        if content.startswith("json"):
+            content = content[4:]
+    content = content.strip()
+
+    result = orjson.loads(content)
+    return {
+        "reformulated_query": result.get("reformulated_query", query),
+        "search_strategy": result.get("intent", "general_search"),
+        "course_code": result.get("course_code")
+    }
+
+
+
+# Course-code matcher run on every query. When google-re2 is installed the pattern
+# is compiled to RE2's automaton, so matching is linear in the query length no
+# matter what a user types (no backtracking). The case-insensitive flag is inline
+# because RE2 doesn't take re.* flags.
+#
+# RE2's \b and \s are ASCII-only while Python's are Unicode-aware (e.g. "éCOMP 250"
+# differs), so RE2 only handles pure-ASCII text — which is nearly every query —
+# and anything else goes through the stdlib pattern. Results are identical either way.
+_COURSE_ID_PATTERN = r'(?i)\b([A-Z]{3,4})[\s\-]?(\d{3}[A-Z]?)\b'
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+class _CourseIdMatcher:
+    """Drop-in for a compiled pattern (findall/search) that prefers RE2 for ASCII input."""
+
+    def __init__(self, pattern: str):
+        self._re = re.compile(pattern)
+        self._re2 = re2.compile(pattern) if re2 else None
+
+    def _pick(self, text: str):
+        return self._re2 if self._re2 is not None and text.isascii() else self._re
+
+    def findall(self, text: str):
+        return self._pick(text).findall(text)
+
+    def search(self, text: str):
+        return self._pick(text).search(text)
+
+
+_COURSE_ID_RE = _CourseIdMatcher(_COURSE_ID_PATTERN)
+
+# Stricter "DEPT NNN" form (space optional, no hyphen), run on uppercased text: course
+# codes listed in prereq_text and the completed courses in an "available" query
+_PLAIN_COURSE_CODE_RE = re.compile(r'\b([A-Z]{3,4})\s*(\d{3}[A-Z]?)\b')
+
+# Phrases that signal the two prereq intents hybrid_search() routes on
+# (also used by understand_query_for_retrieval()). Each list is compiled into one
+# alternation so classifying a query is a single C-level scan instead of a
+# Python loop of `phrase in query` checks. No \b anchors: they match anywhere in
+# the lowercased query, exactly like the substring checks they replace
+# (e.g. "need" also fires on "needed", "require" on "requirement").
+_PREREQS_FOR_RE = re.compile(r"prerequisites? for|prereqs for|what do i need for|requirements for")
+_WHAT_REQUIRES_RE = re.compile(
+    r"require|need|courses that use|after|next|finished|completed|done with|taken|what can i take"
+)
+
+# A query that is only a course code, give or take whitespace and punctuation
+_BARE_COURSE_CODE_RE = re.compile(r'\s*([A-Z]{3,4})[\s\-]?(\d{3}[A-Z]?)\s*[?.!]*\s*$', re.IGNORECASE)
 
 # Common English words that look like department codes (3-4 uppercase letters) but aren't.
 # Without this, "WHAT 200-level courses" would match as course code "WHAT 200".
@@ -398,7 +1010,8 @@ _DEPT_FALSE_POSITIVES = frozenset({
 # Cache for course titles to avoid repeated DB queries
 _title_to_id_cache: dict = {}
 _id_to_title_cache: dict = {}  # Reverse lookup
-_duplicate_titles: dict = {}  # Titles that map to multiple courses
+_duplicate_titles: dict = {}  # Titles that map to multiple courses → tuple of their course IDs
+_known_departments: frozenset = frozenset()  # Every department code in the catalogue ("COMP", ...)
 _cache_loaded = False
 
 def _normalize_title(title: str) -> str:
@@ -406,41 +1019,88 @@ def _normalize_title(title: str) -> str:
     return title.lower().strip().rstrip('.')
 
 def _load_title_cache():
-    """Load all course titles into memory for fast lookups."""
-    global _title_to_id_cache, _id_to_title_cache, _duplicate_titles, _cache_loaded
+    """Load all course titles into memory for fast lookups.
+
+    Built from the in-memory course table rather than its own DB query. That table
+    is restored from the on-disk snapshot (COURSE_CACHE_PATH) when it's fresh, so
+    after the first run a cold start builds the title lookups without touching
+    Postgres at all — and both caches always agree on what's in the catalogue.
+    """
+    global _title_to_id_cache, _id_to_title_cache, _duplicate_titles, _known_departments, _cache_loaded
     if _cache_loaded:
         return
+    _load_course_cache()
     
     # First pass: collect all courses per normalized title
     title_to_courses: dict = {}
-    with DBSession() as session:
-        courses = session.query(Course.id, Course.title).all()
-        for course_id, title in courses:
-            if title:
-                normalized = _normalize_title(title)
-                if normalized not in title_to_courses:
-                    title_to_courses[normalized] = []
-                title_to_courses[normalized].append(course_id)
-                _id_to_title_cache[course_id] = title
+    id_to_title: dict = {}
+    for course_id, course in _course_cache.items():
+        title = course["title"]
+        if title:
+            # Interned: the same string object then keys title_to_id and duplicates
+            normalized = sys.intern(_normalize_title(title))
+            if normalized not in title_to_courses:
+                title_to_courses[normalized] = []
+            title_to_courses[normalized].append(course_id)
+            id_to_title[course_id] = title
     
     # Second pass: identify duplicates and pick default (prefer COMP)
+    title_to_id: dict = {}
+    duplicates: dict = {}
     for normalized, course_ids in title_to_courses.items():
         if len(course_ids) > 1:
-            # Store all options for disambiguation
-            _duplicate_titles[normalized] = course_ids
+            # Store all options for disambiguation (a tuple: it's handed out to
+            # callers through the lookup caches, so it must not be mutable)
+            duplicates[normalized] = tuple(course_ids)
             # Pick default: prefer COMP, then alphabetically first
             comp_courses = [c for c in course_ids if c.startswith('COMP ')]
             if comp_courses:
-                _title_to_id_cache[normalized] = comp_courses[0]
+                title_to_id[normalized] = comp_courses[0]
             else:
-                _title_to_id_cache[normalized] = sorted(course_ids)[0]
+                title_to_id[normalized] = sorted(course_ids)[0]
         else:
-            _title_to_id_cache[normalized] = course_ids[0]
+            title_to_id[normalized] = course_ids[0]
     
+    # Swap in whole new dicts, so a reload never mixes old and new titles
+    _title_to_id_cache, _id_to_title_cache, _duplicate_titles = title_to_id, id_to_title, duplicates
+    # Department code is the part of the ID before the space ("COMP 250" → "COMP")
+    _known_departments = frozenset(course_id.split(" ", 1)[0] for course_id in _course_cache)
     _cache_loaded = True
-
-
-def find_course_by_title(query: str) -> tuple[Optional[str], Optional[list[str]]]:
+    # A (re)load changes what titles resolve to, so drop memoized lookups
+    _find_course_by_title_normalized.cache_clear()
+    _extract_course_id_stripped.cache_clear()
+
+
+# Title matching scans every title in the table, and chat users tend to repeat the
+# same course names, so results are memoized per normalized query (the title table
+# only changes when _load_title_cache() runs, which clears these caches).
+TITLE_LOOKUP_CACHE_SIZE = 4096
+
+# Question phrasing stripped off before title matching, compiled once at import.
+# e.g., "What are the prerequisites for Introduction to Computer Science?"
+# e.g., "What is Introduction to Computer Science about?"
+_TITLE_PREFIX_RES = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r"what are the prerequisites for\s+",
+    r"what are the prereqs for\s+",
+    r"what do i need for\s+",
+    r"prerequisites for\s+",
+    r"prereqs for\s+",
+    r"requirements for\s+",
+    r"what is\s+",
+    r"tell me about\s+",
+    r"describe\s+",
+    r"when is\s+",
+    r"is\s+",
+))
+_TITLE_SUFFIX_RES = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r"\s+about\??$",
+    r"\s+offered\??$",
+    r"\s+like\??$",
+    r"\??$",
+))
+
+
+def find_course_by_title(query: str) -> tuple[Optional[str], Optional[tuple[str, ...]]]:
     """Find a course ID by matching the course title in the query.
     
     Supports:
@@ -450,52 +1110,31 @@ def find_course_by_title(query: str) -> tuple[Optional[str], Optional[list[str]]
     
     Returns a tuple of:
     - course_id: The matched course ID (or default if ambiguous)
-    - alternatives: List of alternative course IDs if ambiguous, None otherwise
+    - alternatives: Tuple of alternative course IDs if ambiguous, None otherwise
     """
     _load_title_cache()
-    
+    # Matching is case-insensitive, so "Data Structures" and "data structures " share an entry
+    return _find_course_by_title_normalized(query.lower().strip())
+
+
+@functools.lru_cache(maxsize=TITLE_LOOKUP_CACHE_SIZE)
+def _find_course_by_title_normalized(query_lower: str) -> tuple[Optional[str], Optional[tuple[str, ...]]]:
+    """find_course_by_title() for an already lowercased, stripped query."""
     if not _title_to_id_cache:
         return None, None
     
-    query_lower = query.lower().strip()
-    
     # Remove common question phrases to isolate the course title
-    # e.g., "What are the prerequisites for Introduction to Computer Science?"
-    # e.g., "What is Introduction to Computer Science about?"
-    prefix_patterns = [
-        r"what are the prerequisites for\s+",
-        r"what are the prereqs for\s+",
-        r"what do i need for\s+",
-        r"prerequisites for\s+",
-        r"prereqs for\s+",
-        r"requirements for\s+",
-        r"what is\s+",
-        r"tell me about\s+",
-        r"describe\s+",
-        r"when is\s+",
-        r"is\s+",
-    ]
-    
-    suffix_patterns = [
-        r"\s+about\??$",
-        r"\s+offered\??$",
-        r"\s+like\??$",
-        r"\??$",
-    ]
-    
+    # (applied one after another, in _TITLE_PREFIX_RES / _TITLE_SUFFIX_RES order)
     cleaned_query = query_lower
-    for pattern in prefix_patterns:
-        cleaned_query = re.sub(pattern, "", cleaned_query, flags=re.IGNORECASE)
-    for pattern in suffix_patterns:
-        cleaned_query = re.sub(pattern, "", cleaned_query, flags=re.IGNORECASE)
+    for pattern in _TITLE_PREFIX_RES:
+        cleaned_query = pattern.sub("", cleaned_query)
+    for pattern in _TITLE_SUFFIX_RES:
+        cleaned_query = pattern.sub("", cleaned_query)
     cleaned_query = _normalize_title(cleaned_query)  # Normalize: strip, lowercase, remove trailing period
     
     def check_ambiguous(normalized_title: str) -> tuple[str, Optional[list[str]]]:
         """Check if a title is ambiguous and return alternatives if so."""
-        course_id = _title_to_id_cache[normalized_title]
-        if normalized_title in _duplicate_titles:
-            return course_id, _duplicate_titles[normalized_title]
-        return course_id, None
+        return _title_to_id_cache[normalized_title], _duplicate_titles.get(normalized_title)
     
     # 1. Exact match on cleaned query
     if cleaned_query in _title_to_id_cache:
@@ -535,7 +1174,7 @@ def extract_all_course_ids(query: str) -> list[str]:
     return result
 
 
-def extract_course_id(query: str) -> tuple[Optional[str], Optional[list[str]]]:
+def extract_course_id(query: str) -> tuple[Optional[str], Optional[tuple[str, ...]]]:
     """Extract a course ID from query, normalize to 'DEPT NNN' format.
 
     Supports both course codes and titles.
@@ -543,12 +1182,19 @@ def extract_course_id(query: str) -> tuple[Optional[str], Optional[list[str]]]:
     Examples:
     - "COMP 250" → ("COMP 250", None)
     - "What are the prerequisites for Introduction to Computer Science?" → ("COMP 250", None)
-    - "What is Operating Systems about?" → ("COMP 310", ["COMP 310", "ECSE 427"]) -- ambiguous
+    - "What is Operating Systems about?" → ("COMP 310", ("COMP 310", "ECSE 427")) -- ambiguous
 
     Returns a tuple of:
     - course_id: The matched course ID
-    - alternatives: List of alternative course IDs if ambiguous, None otherwise
+    - alternatives: Tuple of alternative course IDs if ambiguous, None otherwise
     """
+    # Surrounding whitespace can't change a match, so it's left out of the cache key
+    return _extract_course_id_stripped(query.strip())
+
+
+@functools.lru_cache(maxsize=TITLE_LOOKUP_CACHE_SIZE)
+def _extract_course_id_stripped(query: str) -> tuple[Optional[str], Optional[tuple[str, ...]]]:
+    """extract_course_id() for an already stripped query."""
     # First, try regex match for course code (e.g., "COMP 250") - never ambiguous
     match = _COURSE_ID_RE.search(query)
     if match:
@@ -564,24 +1210,133 @@ def extract_course_id(query: str) -> tuple[Optional[str], Optional[list[str]]]:
 
 
 
+# In-memory course table.
+#
+# The catalogue is a few thousand rows and only changes when the scraper runs, so
+# instead of opening a SQLAlchemy session and paying a Postgres round-trip for
+# every get_course_directly()/enrich_context() call (several per question), we
+# load the whole table once and answer both from this dict.
+_course_cache: dict[str, dict] = {}
+_course_cache_loaded = False
+_course_cache_lock = threading.Lock()
+_course_cache_generation = 0  # bumped by refresh_course_cache(); see course_cache_generation()
+
+# The table is also snapshotted to disk, so a restart reads one pickle (tens of
+# ms) instead of re-running the full Postgres load. The courses table has no
+# "last updated" column to compare against, so the snapshot simply expires after
+# COURSE_CACHE_TTL seconds (the catalogue changes daily at most). Every script
+# that writes to the courses table deletes it when done (invalidate_course_snapshot),
+# and refresh_course_cache() always rewrites it from the DB.
+COURSE_CACHE_PATH = pathlib.Path(os.getenv("COURSE_CACHE_PATH", pathlib.Path(__file__).parent / "cache" / "courses.pkl"))
+COURSE_CACHE_TTL = int(os.getenv("COURSE_CACHE_TTL", 24 * 60 * 60))
+
+
+def _read_course_cache_file() -> Optional[dict]:
+    """Return the on-disk course snapshot if it exists and is fresh, else None."""
+    try:
+        if time.time() - COURSE_CACHE_PATH.stat().st_mtime > COURSE_CACHE_TTL:
+            return None
+        with open(COURSE_CACHE_PATH, "rb") as f:
+            data = pickle.load(f)
+        return data if isinstance(data, dict) else None
+    except Exception:
+        return None  # missing, unreadable or from an incompatible version — reload from the DB
+
+
+def _write_course_cache_file(data: dict):
+    """Snapshot the course table to disk (best effort — a failure only costs the next cold start)."""
+    try:
+        COURSE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file and rename, so a reader never sees a half-written pickle
+        tmp_path = COURSE_CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=5)
+        os.replace(tmp_path, COURSE_CACHE_PATH)
+    except OSError as e:
+        print(f"[CACHE] Could not write {COURSE_CACHE_PATH}: {e}")
+
+
+def invalidate_course_snapshot():
+    """Delete the on-disk course snapshot, so the next start loads from the DB.
+
+    Call after the last commit of anything that writes to the courses table —
+    otherwise a restart within COURSE_CACHE_TTL keeps serving the old rows.
+    The lock file stays: a process may be waiting on it right now.
+    """
+    COURSE_CACHE_PATH.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def _course_cache_file_lock():
+    """Hold an exclusive lock on the disk snapshot, shared by every process on this host.
+
+    Several server processes (uvicorn --workers, a CLI run next to the server) can
+    start at once with no fresh snapshot. Under the lock, the first one loads from
+    Postgres and writes the pickle; the others wait and then read that pickle
+    instead of all running the same full-table query. POSIX only (fcntl) — where
+    it isn't available, each process simply loads on its own as before.
+    """
+    try:
+        import fcntl
+        COURSE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        lock_file = open(COURSE_CACHE_PATH.with_suffix(".lock"), "a")
+    except (ImportError, OSError):
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+        yield
+
+
+def _load_course_cache(force: bool = False):
+    """Load every course into _course_cache (once, unless force=True).
+
+    Uses the on-disk snapshot when it's fresh; force=True always goes to the DB.
+    """
+    global _course_cache, _course_cache_loaded
+    if _course_cache_loaded and not force:
+        return
+    with _course_cache_lock:
+        if _course_cache_loaded and not force:
+            return  # another thread loaded it while we waited
+        with _course_cache_file_lock():
+            fresh = None if force else _read_course_cache_file()
+            if fresh is None:
+                with DBSession() as session:
+                    fresh = {r.id: course_to_dict(r) for r in session.execute(select(*COURSE_DICT_COLUMNS))}
+                _write_course_cache_file(fresh)
+        # Swap in a whole new dict so readers never see a half-built table
+        _course_cache = fresh
+        _course_cache_loaded = True
+
+
+def refresh_course_cache():
+    """Reload the in-memory course table (and its disk snapshot) from the DB."""
+    global _cache_loaded, _course_cache_generation
+    _load_course_cache(force=True)
+    _cache_loaded = False  # title lookups are rebuilt from the new table on next use
+    # ...but a query seen before answers from these memos without reaching the
+    # title cache, so it would never trigger that rebuild — drop them here too
+    _find_course_by_title_normalized.cache_clear()
+    _extract_course_id_stripped.cache_clear()
+    _course_cache_generation += 1
+
+
+def course_cache_generation() -> int:
+    """Counter that changes whenever the course data was reloaded from the DB.
+
+    Other per-course caches (server.py's /courses responses) put it in their key,
+    so a refresh makes their old entries unreachable.
+    """
+    return _course_cache_generation
+
+
 def get_course_directly(course_id: str) -> Optional[dict]:
-    """Fetch a single course by exact ID from the database."""
-    with DBSession() as session:
-        course = session.query(Course).filter_by(id=course_id).first()
-        if course:
-            return {
-                "id": course.id,
-                "title": course.title,
-                "department": course.offered_by,
-                "credits": float(course.credits or 0),
-                "prereqs": course.prereq_text,
-                "coreqs": course.coreq_text,
-                "description": course.description,
-                "offered_fall": course.offered_fall,
-                "offered_winter": course.offered_winter,
-                "offered_summer": course.offered_summer,
-            }
-    return None
+    """Fetch a single course by exact ID (served from the in-memory course table)."""
+    _load_course_cache()
+    course = _course_cache.get(course_id)
+    # Copy so a caller editing its result can't corrupt the shared table
+    return dict(course) if course else None
 
 
 # STEP 5️⃣ — Planning & Recommendation Queries
@@ -597,59 +1352,48 @@ def get_entry_level_courses(department: str = None, term: str = None, limit: int
     Returns:
         List of course dicts sorted by course number (lowest first)
     """
-    with DBSession() as session:
-        query = session.query(Course)
-        
-        # Filter by department if specified
-        if department:
-            query = query.filter(Course.id.like(f"{department.upper()} %"))
-        
-        # Get all matching courses
-        courses = query.all()
-        
-        # Filter for entry-level (no prereqs or minimal prereqs)
-        entry_level = []
-        for c in courses:
-            prereq_text = (c.prereq_text or "").strip().lower()
-            # No prerequisites or just CEGEP/high school requirements
-            is_entry = (
-                not prereq_text or 
-                prereq_text == "none" or
-                "cegep" in prereq_text and "comp" not in prereq_text.lower() and "math" not in prereq_text.lower()
-            )
-            if is_entry:
-                # Check term if specified
-                if term:
-                    term_lower = term.lower()
-                    if term_lower == 'fall' and not c.offered_fall:
-                        continue
-                    if term_lower == 'winter' and not c.offered_winter:
-                        continue
-                    if term_lower == 'summer' and not c.offered_summer:
-                        continue
-                
-                entry_level.append({
-                    "id": c.id,
-                    "title": c.title,
-                    "department": c.offered_by,
-                    "credits": float(c.credits or 0),
-                    "prereqs": c.prereq_text,
-                    "coreqs": c.coreq_text,
-                    "description": c.description,
-                    "offered_fall": c.offered_fall,
-                    "offered_winter": c.offered_winter,
-                    "offered_summer": c.offered_summer,
-                })
-        
-        # Sort by course number (extract number from ID like "COMP 250" -> 250)
-        def get_course_num(course):
-            try:
-                return int(course["id"].split()[1][:3])
-            except:
-                return 999
-        
-        entry_level.sort(key=get_course_num)
-        return entry_level[:limit]
+    # An unknown department (typo, made-up code) can't match anything: answer
+    # from the in-memory department set instead of scanning the table for it
+    if department:
+        _load_title_cache()
+        if department.upper() not in _known_departments:
+            return []
+
+    # Served from the in-memory course table, which already holds every column
+    # this needs in the shape we return, instead of loading full ORM rows
+    _load_course_cache()
+    prefix = f"{department.upper()} " if department else ""
+    term_key = f"offered_{term.lower()}" if term and term.lower() in ("fall", "winter", "summer") else None
+
+    # Filter for entry-level (no prereqs or minimal prereqs)
+    entry_level = []
+    for course_id, c in _course_cache.items():
+        if not course_id.startswith(prefix):
+            continue
+        prereq_text = (c["prereqs"] or "").strip().lower()
+        # No prerequisites or just CEGEP/high school requirements
+        is_entry = (
+            not prereq_text or 
+            prereq_text == "none" or
+            "cegep" in prereq_text and "comp" not in prereq_text and "math" not in prereq_text
+        )
+        if not is_entry:
+            continue
+        # Check term if specified
+        if term_key and not c[term_key]:
+            continue
+        # Copy so a caller editing its result can't corrupt the shared table
+        entry_level.append(dict(c))
+    
+    # Sort by course number (extract number from ID like "COMP 250" -> 250)
+    def get_course_num(course):
+        try:
+            return int(course["id"].split()[1][:3])
+        except:
+            return 999
+    
+    entry_level.sort(key=get_course_num)
+    return entry_level[:limit]
 
 
 def get_courses_by_level(department: str, level: int, term: str = None, limit: int = 10) -> list[dict]:
@@ -746,7 +1490,7 @@ def get_available_courses(completed_courses: list[str], department: str = None,
             
             # Check if prereqs are satisfied
             # Extract course codes from prereq text
-            prereq_codes = set(re.findall(r'\b([A-Z]{3,4})\s*(\d{3}[A-Z]?)\b', prereq_text.upper()))
+            prereq_codes = set(_PLAIN_COURSE_CODE_RE.findall(prereq_text.upper()))
             prereq_ids = {f"{dept} {num}" for dept, num in prereq_codes}
             
             # Simple check: if any prereq is in completed courses, consider it potentially available
@@ -777,23 +1521,51 @@ def get_available_courses(completed_courses: list[str], department: str = None,
         return result[:limit]
 
 
-def detect_planning_query(query: str) -> Optional[dict]:
-    """Detect if the query is a planning/recommendation query.
-    
-    Returns a dict with:
-        - type: 'first_semester', 'by_level', 'available', 'recommendation'
-        - department: extracted department (e.g., 'COMP')
-        - term: extracted term (e.g., 'fall', 'winter')
-        - level: extracted level for level-based queries
-        - completed: list of completed courses (for 'available' type)
-    
-    Returns None if not a planning query.
-    """
-    query_lower = query.lower()
-    result = {"type": None, "department": None, "term": None, "level": None, "completed": []}
-    
-    # Extract department
-    dept_patterns = [
+# detect_planning_query() rules: four ordered tables (department, term, level, query
+# type). In each table the first rule that matches anywhere in the lowercased query
+# wins, e.g. "art history" → HIST because HIST is listed before ARTH.
+#
+# Rather than one re.search per rule (~70 scans of the query), all tables go into a
+# single RE2 Set: one DFA pass over the query reports the index of every rule that
+# matches, and each table just takes its lowest index. Non-ASCII queries (RE2's \b
+# and \s are ASCII-only, see _COURSE_ID_PATTERN) or a missing re2 fall back to the
+# rule-by-rule stdlib searches. Results are identical either way.
+class _FirstRuleScanner:
+    """Finds, for several ordered (pattern, value) tables, the first rule that matches."""
+
+    def __init__(self, **tables):
+        self._rules = []  # (table, value, compiled stdlib pattern), in table order
+        for table, rules in tables.items():
+            for pattern, value in rules:
+                self._rules.append((table, value, re.compile(pattern)))
+        self._set = None
+        if re2:
+            self._set = re2.Set.SearchSet()
+            for _, _, compiled in self._rules:
+                self._set.Add(compiled.pattern)
+            self._set.Compile()
+
+    def first(self, text: str) -> dict:
+        """Map each table with a matching rule to (value, match) of its first such rule."""
+        if self._set is not None and text.isascii():
+            indices = sorted(self._set.Match(text) or ())
+        else:
+            indices = range(len(self._rules))
+        found = {}
+        for i in indices:
+            table, value, compiled = self._rules[i]
+            if table in found:
+                continue
+            # RE2 already knows this rule matches; the search just gets the match
+            # object (only needed for "200-level"), and is the check on the fallback.
+            match = compiled.search(text)
+            if match:
+                found[table] = (value, match)
+        return found
+
+
+_PLANNING_RULES = _FirstRuleScanner(
+    department=[
         # Computer Science & Engineering
         (r'\b(cs|comp(?:uter)?(?:\s+science)?)\b', 'COMP'),
         (r'\b(software\s+engineering?|swe)\b', 'ECSE'),
@@ -838,22 +1610,15 @@ def detect_planning_query(query: str) -> Optional[dict]:
         (r'\b(nurs(?:ing)?)\b', 'NURS'),
         (r'\b(envir(?:onmental)?(?:\s+stud(?:ies)?)?|envi)\b', 'ENVI'),
         (r'\b(educ(?:ation)?|edpe|edsl)\b', 'EDPE'),
-    ]
-    for pattern, dept in dept_patterns:
-        if re.search(pattern, query_lower):
-            result["department"] = dept
-            break
-    
-    # Extract term
-    if any(t in query_lower for t in ['fall', 'autumn', 'first semester', 'semester 1', 'f1']):
-        result["term"] = "fall"
-    elif any(t in query_lower for t in ['winter', 'second semester', 'semester 2', 'w2']):
-        result["term"] = "winter"
-    elif 'summer' in query_lower:
-        result["term"] = "summer"
-    
-    # Extract level/year (U2/U3/U4 are McGill-specific year notations)
-    level_patterns = [
+    ],
+    # Plain substrings (no \b)
+    term=[
+        (r'fall|autumn|first semester|semester 1|f1', 'fall'),
+        (r'winter|second semester|semester 2|w2', 'winter'),
+        (r'summer', 'summer'),
+    ],
+    # Level/year (U2/U3/U4 are McGill-specific year notations)
+    level=[
         (r'\bu2\b', 200),
         (r'\bu3\b', 300),
         (r'\bu4\b', 400),
@@ -862,57 +1627,82 @@ def detect_planning_query(query: str) -> Optional[dict]:
         (r'\b(fourth|4th|senior)\s*(year)?\b', 400),
         (r'\b(graduate|grad|masters?|phd)\b', 500),
         (r'\b(\d)00[\s-]?level\b', None),  # "200-level" - extract from match
-    ]
-    for pattern, level in level_patterns:
-        match = re.search(pattern, query_lower)
-        if match:
-            if level is None:
-                # Extract from pattern like "200-level"
-                result["level"] = int(match.group(1)) * 100
-            else:
-                result["level"] = level
-            break
+    ],
+    # Query type, in the order detect_planning_query() checks them
+    type=[
+        # First semester / entry level
+        (r'\bu0\b', 'first_semester'),      # McGill U0 (Foundation Program) → entry-level
+        (r'\bu1\b', 'first_semester'),      # McGill U1 (first year) → entry-level courses
+        (r'foundation\s+program', 'first_semester'),
+        (r'first\s*(semester|year)', 'first_semester'),
+        (r'start(ing)?\s*(with|out)', 'first_semester'),
+        (r'begin(ning|ner)?', 'first_semester'),
+        (r'intro(ductory|duction)?', 'first_semester'),
+        (r'entry[\s-]?level', 'first_semester'),
+        (r'no\s*prereq', 'first_semester'),
+        (r'should\s+i\s+take\s+first', 'first_semester'),
+        (r'take\s+first', 'first_semester'),
+        # "Available after completing X"
+        # Only match when multiple courses are mentioned (e.g., "after COMP 250 and MATH 133")
+        (r'(after|with|having|completed?|done|finished|took)\s+[A-Z]{3,4}\s*\d{3}.+[A-Z]{3,4}\s*\d{3}', 'available'),
+        (r'available\s+to\s+(me|take)', 'available'),
+        # General recommendation
+        (r'should\s+i\s+take', 'recommendation'),
+        (r'recommend', 'recommendation'),
+        (r'suggest', 'recommendation'),
+        (r'best\s+courses?', 'recommendation'),
+        (r'good\s+courses?', 'recommendation'),
+        (r'what\s+courses?\s+(should|to)', 'recommendation'),
+    ],
+)
+
+
+def detect_planning_query(query: str) -> Optional[dict]:
+    """Detect if the query is a planning/recommendation query.
     
-    # Detect query type
-    first_semester_patterns = [
-        r'\bu0\b',                          # McGill U0 (Foundation Program) → entry-level
-        r'\bu1\b',                          # McGill U1 (first year) → entry-level courses
-        r'foundation\s+program',
-        r'first\s*(semester|year)',
-        r'start(ing)?\s*(with|out)',
-        r'begin(ning|ner)?',
-        r'intro(ductory|duction)?',
-        r'entry[\s-]?level',
-        r'no\s*prereq',
-        r'should\s+i\s+take\s+first',
-        r'take\s+first',
-    ]
+    Returns a dict with:
+        - type: 'first_semester', 'by_level', 'available', 'recommendation'
+        - department: extracted department (e.g., 'COMP')
+        - term: extracted term (e.g., 'fall', 'winter')
+        - level: extracted level for level-based queries
+        - completed: list of completed courses (for 'available' type)
     
-    available_patterns = [
-        # Only match when multiple courses are mentioned (e.g., "after COMP 250 and MATH 133")
-        r'(after|with|having|completed?|done|finished|took)\s+[A-Z]{3,4}\s*\d{3}.+[A-Z]{3,4}\s*\d{3}',
-        r'available\s+to\s+(me|take)',
-    ]
+    Returns None if not a planning query.
+    """
+    query_lower = query.lower()
+    result = {"type": None, "department": None, "term": None, "level": None, "completed": []}
+    
+    # One scan finds the first matching rule of every table
+    found = _PLANNING_RULES.first(query_lower)
+    
+    # Extract department and term
+    if "department" in found:
+        result["department"] = found["department"][0]
+    if "term" in found:
+        result["term"] = found["term"][0]
+    
+    # Extract level/year
+    if "level" in found:
+        level, match = found["level"]
+        if level is None:
+            # Extract from pattern like "200-level"
+            result["level"] = int(match.group(1)) * 100
+        else:
+            result["level"] = level
     
-    recommendation_patterns = [
-        r'should\s+i\s+take',
-        r'recommend',
-        r'suggest',
-        r'best\s+courses?',
-        r'good\s+courses?',
-        r'what\s+courses?\s+(should|to)',
-    ]
+    # Detect query type
+    query_type = found["type"][0] if "type" in found else None
     
     # Check for first semester / entry level queries
-    if any(re.search(p, query_lower) for p in first_semester_patterns):
+    if query_type == "first_semester":
         result["type"] = "first_semester"
         return result
     
     # Check for "available after completing X" queries
-    if any(re.search(p, query_lower) for p in available_patterns):
+    if query_type == "available":
         result["type"] = "available"
         # Extract completed courses from query
-        completed = re.findall(r'\b([A-Z]{3,4})\s*(\d{3}[A-Z]?)\b', query.upper())
+        completed = _PLAIN_COURSE_CODE_RE.findall(query.upper())
         result["completed"] = [f"{dept} {num}" for dept, num in completed]
         return result
     
@@ -922,7 +1712,7 @@ def detect_planning_query(query: str) -> Optional[dict]:
         return result
     
     # Check for general recommendation queries
-    if any(re.search(p, query_lower) for p in recommendation_patterns):
+    if query_type == "recommendation":
         result["type"] = "recommendation"
         return result
 
@@ -938,17 +1728,74 @@ def detect_planning_query(query: str) -> Optional[dict]:
 
 # STEP 4️⃣ — Hybrid Search: Combine semantic + structured logic
 
+# Searches currently running in hybrid_search(), by cache key → Future of their results
+_hybrid_inflight: dict[tuple, concurrent.futures.Future] = {}
+_hybrid_inflight_lock = threading.Lock()
+
+
 def hybrid_search(query: str, dept: str = None, prereq_of: str = None, n_results: int = 50): # Hybrid Search (semantic + deterministic)
     """Combine semantic retrieval with my logic from the SQLAlchemy layer.
     
-    Uses LLM to understand query intent and reformulate for better retrieval.
+    Query intent is detected deterministically (course-code regex + intent phrases).
     
     Returns a list of course dicts. If ambiguous, the first result will have
     'needs_clarification': True and 'alternatives': [...] with course options.
     
     For planning queries, returns a list with 'is_planning_query': True and
     'planning_type' indicating the type of recommendation.
+
+    Results are kept in the same LRU as semantic_search() (see SEARCH_CACHE_SIZE),
+    so a repeated question skips routing, the DB helpers and the vector search
+    altogether. Every step above is case-insensitive, hence the normalized key.
+    The results carry rows of the in-memory course table, so the key includes its
+    generation as well as the index version: after either one changes, old
+    entries can't be hit and age out of the LRU.
     """
+    key = ("hybrid", _index_version, _course_cache_generation,
+           query.strip().lower(), dept, prereq_of, n_results)
+    cached = _search_cache_get(key)
+    if cached is not None:
+        return cached
+
+    # Single-flight: if the same search is already running on another thread, wait
+    # for its result instead of running the whole pipeline a second time.
+    with _hybrid_inflight_lock:
+        future = _hybrid_inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _hybrid_inflight[key] = concurrent.futures.Future()
+    if not leader:
+        # Copies, like a cache hit (raises the leader's exception if it failed)
+        return [dict(r) for r in future.result()]
+
+    try:
+        results = _hybrid_search(query, dept, prereq_of, n_results)
+        _search_cache_put(key, results)
+        # Waiters copy from a snapshot, since our caller may edit `results`
+        future.set_result([dict(r) for r in results])
+        return results
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        # After the cache put, so a late caller finds the result there instead
+        with _hybrid_inflight_lock:
+            del _hybrid_inflight[key]
+
+
+def _hybrid_search(query: str, dept: str = None, prereq_of: str = None, n_results: int = 50):
+    """hybrid_search() without the result cache."""
+
+    # Shortcut: the query is nothing but a course code ("COMP 250", "comp-250?").
+    # The full pipeline would end up fetching exactly that course (FIX 5 below),
+    # so do it straight away and skip planning/title/intent detection. Codes whose
+    # "department" is really an English word go the long way, as does a miss.
+    if not prereq_of:
+        match = _BARE_COURSE_CODE_RE.match(query)
+        if match and match.group(1).upper() not in _DEPT_FALSE_POSITIVES:
+            course = get_course_directly(f"{match.group(1).upper()} {match.group(2).upper()}")
+            if course:
+                return [{"course_id": course["id"], "score": 0.0, **course}]
 
     # ✅ NEW: Check for planning/recommendation queries first
     # BUT: skip planning detection if query mentions a specific course code
@@ -1000,15 +1847,9 @@ def hybrid_search(query: str, dept: str = None, prereq_of: str = None, n_results
 
     # ✅ FIX 2: Detect query intent
     query_lower = query.lower()
-    is_asking_prereqs_for = course_id and any(phrase in query_lower for phrase in [
-        "prerequisite for", "prerequisites for", "prereqs for", 
-        "what do i need for", "requirements for"
-    ])
-
-    is_asking_what_requires = course_id and any(phrase in query_lower for phrase in [ 
-        "require", "need", "courses that use", "after", "next", 
-    "finished", "completed", "done with", "taken", "what can i take"
-    ]) and "for" not in query_lower
+    is_asking_prereqs_for = course_id and _PREREQS_FOR_RE.search(query_lower) is not None
+
+    is_asking_what_requires = course_id and _WHAT_REQUIRES_RE.search(query_lower) is not None and "for" not in query_lower
     # ✅ This correctly excludes "prerequisites FOR X" queries
 
     # ✅ FIX 3: Handle "prerequisites FOR X" - just fetch X's prereq_text
@@ -1023,7 +1864,7 @@ def hybrid_search(query: str, dept: str = None, prereq_of: str = None, n_results
             # Add disambiguation info if ambiguous
             if alternatives and len(alternatives) > 1:
                 result["needs_clarification"] = True
-                result["alternatives"] = alternatives
+                result["alternatives"] = list(alternatives)
             return [result]
         # Course not found, fall through to semantic search
         # (This is intentional - we want to give semantic search a chance)
@@ -1033,11 +1874,7 @@ def hybrid_search(query: str, dept: str = None, prereq_of: str = None, n_results
 
     # Handle prereq_of (courses that require this course)
     if prereq_of:
-        prereq_targets = get_courses_requiring(prereq_of) or []
-        if not prereq_targets:
-            return []
-        enriched = enrich_context(prereq_targets)
-        return [{"course_id": e["id"], "score": 0.0, **{k: v for k, v in e.items() if k != "id"}} for e in enriched]
+        return _requiring_results(prereq_of)
     
     # ✅ FIX 5: If query mentions course IDs, fetch ALL of them directly
     all_course_ids = extract_all_course_ids(query)
@@ -1055,11 +1892,14 @@ def hybrid_search(query: str, dept: str = None, prereq_of: str = None, n_results
             # Add disambiguation info if the first course was ambiguous
             if alternatives and len(alternatives) > 1:
                 results[0]["needs_clarification"] = True
-                results[0]["alternatives"] = alternatives
+                results[0]["alternatives"] = list(alternatives)
             return results
     
-    # Fall back to semantic search for general queries
-    combined = semantic_search(query, n_results)
+    # Fall back to semantic search for general queries.
+    # If the caller pinned a department, let Chroma filter on the "department"
+    # metadata during the search itself rather than trimming results afterwards.
+    where = {"department": dept.upper()} if dept else None
+    combined = semantic_search(query, n_results, where=where)
 
     # Context enrichment: if a department was identified but no structured route matched,
     # inject that department's courses so the LLM has relevant data to reason with.
@@ -1077,25 +1917,64 @@ def hybrid_search(query: str, dept: str = None, prereq_of: str = None, n_results
 
     return combined
 
+
+def _requiring_results(course_id: str) -> list[dict]:
+    """Search results for the courses that list course_id as a prerequisite."""
+    # One query returns the requiring courses with all their columns
+    enriched = get_courses_requiring_enriched(course_id)
+    return [{"course_id": e["id"], "score": 0.0, **{k: v for k, v in e.items() if k != "id"}} for e in enriched]
+
+def hybrid_search_llm(query: str, dept: str = None, n_results: int = 50):
+    """Opt-in variant of hybrid_search() that lets the LLM read the query's intent.
+
+    Queries with a course code are still classified by regex; only code-less ones
+    cost an LLM call (memoized). The LLM's verdict then picks the route: a
+    "prereq_lookup" goes straight to the requiring-courses lookup, anything else
+    runs hybrid_search() on the reformulated query. Same module, same caches —
+    callers just import whichever entry point they want.
+    """
+    understanding = understand_query_for_retrieval(query, use_llm=True)
+    if understanding["search_strategy"] == "prereq_lookup" and understanding["course_code"]:
+        # The LLM may spell the code loosely ("comp250"); normalize it like any query
+        prereq_of = extract_course_id(understanding["course_code"])[0] or understanding["course_code"]
+        return _requiring_results(prereq_of)
+    return hybrid_search(understanding["reformulated_query"], dept=dept, n_results=n_results)
+
 def enrich_context(course_ids: list[str]): # Context Enrichment (post-retrieval)
-    """Fetch additional info (credits, offered_by, prereqs/coreqs) for retrieved courses.""" # given a list of course IDs, return enriched info from the DB
-    with DBSession() as session:
-        courses = session.query(Course).filter(Course.id.in_(course_ids)).all()
-        enriched = []
-        for c in courses:
-            enriched.append({
-                "id": c.id,
-                "title": c.title,
-                "department": c.offered_by,
-                "credits": float(c.credits or 0),
-                "offered_fall": c.offered_fall,
-                "offered_winter": c.offered_winter,
-                "offered_summer": c.offered_summer,
-                "prereqs": c.prereq_text,
-                "coreqs": c.coreq_text,
-                "description": c.description,
-            })
-        return enriched
+    """Fetch additional info (credits, offered_by, prereqs/coreqs) for retrieved courses.
+
+    Served from the in-memory course table. Results follow the order of
+    course_ids (so relevance order survives), with duplicates and unknown IDs dropped.
+    """
+    _load_course_cache()
+    cache = _course_cache
+    return [dict(cache[cid]) for cid in dict.fromkeys(course_ids) if cid in cache]
+
+
+# ── Async wrappers ───────────────────────────────────────────────────────────
+# SQLAlchemy sessions and the hybrid planner are blocking, so these just move
+# the call onto a worker thread. That lets qa_agent overlap retrieval with DB
+# lookups (and with other requests) on one event loop instead of running them
+# back to back. Course lookups only need the thread until the in-memory course
+# table has been loaded; after that they're plain dict reads.
+
+async def hybrid_search_async(query: str, dept: str = None, prereq_of: str = None, n_results: int = 50):
+    """Awaitable hybrid_search(). Its semantic step still joins the shared embedding batch."""
+    return await asyncio.to_thread(hybrid_search, query, dept, prereq_of, n_results)
+
+
+async def enrich_context_async(course_ids: list[str]):
+    """Awaitable enrich_context()."""
+    if _course_cache_loaded:
+        return enrich_context(course_ids)  # pure dict lookups — no thread hop needed
+    return await asyncio.to_thread(enrich_context, course_ids)
+
+
+async def get_course_directly_async(course_id: str) -> Optional[dict]:
+    """Awaitable get_course_directly()."""
+    if _course_cache_loaded:
+        return get_course_directly(course_id)
+    return await asyncio.to_thread(get_course_directly, course_id)
 
 
 
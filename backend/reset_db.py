@@ -1,12 +1,39 @@
+import sys
+from sqlalchemy import text
 from db_setup import Base, Course
 from db_connection import engine
+from rag_layer import COURSE_CACHE_PATH, invalidate_course_snapshot
 
-print("Dropping all tables...")
-# This will drop the 'courses' and 'prereq_edge' tables
-Base.metadata.drop_all(engine)
-print("Tables dropped.")
+# Usage:
+#   python reset_db.py            → empty every table (schema untouched)
+#   python reset_db.py --migrate  → drop and re-create every table (after a schema change)
+#
+# Emptying is the common case, and TRUNCATE does it in one statement without
+# DDL: no catalog churn, and Postgres keeps its cached plans for these tables.
+# Dropping/re-creating is only needed when db_setup.py's models have changed.
+if "--migrate" in sys.argv[1:]:
+    print("Dropping all tables...")
+    # This will drop the 'courses' and 'prereq_edge' tables
+    Base.metadata.drop_all(engine)
+    print("Tables dropped.")
 
-print("Creating all tables...")
-# This will re-create them with the correct schema
-Base.metadata.create_all(engine)
-print("Tables created.")
\ No newline at end of file
+    print("Creating all tables...")
+    # This will re-create them with the correct schema
+    Base.metadata.create_all(engine)
+    print("Tables created.")
+else:
+    # create_all() is a no-op for tables that already exist; it just makes sure
+    # TRUNCATE has something to empty on a fresh database.
+    Base.metadata.create_all(engine)
+    tables = ", ".join(t.name for t in Base.metadata.sorted_tables)
+    print(f"Truncating {tables}...")
+    with engine.begin() as conn:
+        conn.execute(text(f"TRUNCATE TABLE {tables} RESTART IDENTITY CASCADE"))
+    print("Tables emptied.")
+
+# The server snapshots the courses table to COURSE_CACHE_PATH (env COURSE_CACHE_PATH,
+# default backend/cache/courses.pkl). The table is empty now, so drop the stale
+# snapshot, along with the lock file processes take while (re)building it.
+invalidate_course_snapshot()
+COURSE_CACHE_PATH.with_suffix(".lock").unlink(missing_ok=True)
+print("Course cache snapshot removed.")
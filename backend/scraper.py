@@ -1,78 +1,401 @@
+import asyncio
+import os
+import pathlib
 import re
+import threading
 import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
 from urllib.parse import urljoin
+import aiohttp
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml import etree
+from lxml import html as lxml_html
+from sqlalchemy import insert, select, update
 
 from db_connection import Session
 from db_setup import Course
 
 BASE_URL = "https://coursecatalogue.mcgill.ca/courses/"
 
-def fetch_html(url: str, retries: int = 3) -> str:
-    """Fetch HTML content from a URL with retry logic."""
-    for attempt in range(retries):
+
+def course_slug(course_id: str) -> str:
+    """Catalogue path segment for a course: "COMP 250" → "comp-250" (page at BASE_URL + slug)."""
+    # IDs always have exactly one space, so a plain replace is all it takes
+    return course_id.replace(' ', '-').lower()
+
+
+# Regexes used per link / per page, compiled once at import instead of on every call
+_LIST_LINK_RE = re.compile(r"^/courses/[A-Za-z]{4}-\d{3}(/index\.html)?$")
+_INDEX_HTML_RE = re.compile(r"/index\.html$")
+# The link passes only look at <a href> tags: parsing with a SoupStrainer builds
+# just those, not the nav/scripts/text that make up most of the catalog page
+_ANCHORS_ONLY = SoupStrainer('a', href=True)
+# "COMP 273. Intro to ... | McGill" or "COMP 273 - Intro to ... | McGill"
+_TITLE_RE = re.compile(r'([A-Z]{3,4}[- ]?\d{3}[A-Z]?)(?:\.\s+|\s*[-–]\s*)(.+?)\s+\|')
+_URL_ID_RE = re.compile(r'/courses/([a-z]{3,4})-(\d{3}[a-z]?)/?', re.IGNORECASE)
+_CATALOG_LINK_RE = re.compile(r"^/courses/([a-z]{3,4})-(\d{3}[a-z]?)(?:/index\.html)?$", re.IGNORECASE)
+_CREDITS_RE = re.compile(r'(\d+\.?\d*)')
+_PREREQ_LI_RE = re.compile(r'Prerequisite[s()\s]*:', re.I)
+_COREQ_LI_RE = re.compile(r'Corequisite[s()\s]*:', re.I)
+_PREREQ_RE = re.compile(r'Prerequisite[\s(s)]*:', re.I)
+_COREQ_RE = re.compile(r'Corequisite[\s(s)]*:', re.I)
+# Course codes in prereq/coreq text. This stays a regex on purpose: findall runs the
+# whole scan in C, and a hand-written Python loop over the characters (or bytes) was
+# ~4x slower on typical prereq blurbs; RE2 was slower still on strings this short.
+_COURSE_CODE_RE = re.compile(r'([A-Z]{3,4}[- ]?\d{3})')
+
+
+# parse_course_page() runs once per catalogue page (thousands per scrape), so it
+# works on lxml's tree directly instead of BeautifulSoup's. BS4 wraps every node
+# in a Python object; with lxml the lookups below are compiled XPath expressions
+# evaluated inside libxml2.
+def _has_class(name: str) -> str:
+    """XPath predicate: the element's class list contains `name` (like BS4's class_=)."""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+_TITLE_XPATH = etree.XPath("//title")
+_DESC_XPATH = etree.XPath(f"//div[{_has_class('section__content')}]")
+_CREDITS_XPATH = etree.XPath('//div[@class="text detail-credits"]')
+_OFFERED_BY_XPATH = etree.XPath('//div[@class="text detail-offered_by margin--tiny"]')
+_VALUE_SPAN_XPATH = etree.XPath(f".//span[{_has_class('value')}]")
+_TERMS_XPATH = etree.XPath(f"//div[{_has_class('detail-terms_offered')}]//span[{_has_class('value')}]")
+_NOTE_XPATH = etree.XPath(f"//div[{_has_class('detail-note_text')}]")
+_LI_XPATH = etree.XPath(".//li")
+# Case-insensitive substring prefilter for the old-format fallback: one pass in
+# libxml2 returns only the text nodes mentioning "...requisite" (covers both
+# prerequisite and corequisite), in document order, for the exact regex checks.
+_REQUISITE_TEXT_XPATH = etree.XPath('//text()[contains(translate(., "PREQUISTCO", "prequistco"), "requisite")]')
+
+
+def _first(xpath, node):
+    """First match of a compiled XPath, or None."""
+    matches = xpath(node)
+    return matches[0] if matches else None
+
+
+def _stripped_text(el) -> str:
+    """Same as BS4's get_text(strip=True): every text piece stripped, then joined."""
+    return "".join(t.strip() for t in el.itertext())
+
+
+def _text_node_parent(text):
+    """Element that contains an XPath text() result (a tail belongs to its parent's parent)."""
+    parent = text.getparent()
+    return parent.getparent() if text.is_tail else parent
+
+# Rate limiting shared by every fetch, sync or async. A token bucket lets requests
+# through at FETCH_RATE per second on average with bursts of up to FETCH_BURST, so
+# an idle server gets full throughput instead of a fixed sleep after every page,
+# and concurrent workers draw from one global budget instead of each sleeping on
+# its own. When the server pushes back (429/503) or says its quota is used up
+# (X-RateLimit-Remaining: 0), the whole bucket pauses for as long as it asks.
+FETCH_RATE = 4.0
+FETCH_BURST = 8
+RATE_LIMIT_BACKOFF = (0.5, 1, 2, 4)  # waits between 429/503 retries when the server gives no Retry-After
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks (or acquire_async() awaits) until a token is free."""
+
+    def __init__(self, rate_per_sec: float = FETCH_RATE, burst: int = FETCH_BURST):
+        self.rate = rate_per_sec
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserve(self) -> float:
+        """Take a token and return how long the caller has to wait before using it."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            # A negative balance is tokens already promised to earlier callers
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold every caller back for `seconds` from now."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+
+_BUCKET = TokenBucket()
+
+
+def _retry_after_seconds(headers) -> Optional[float]:
+    """How long the server asked us to wait (Retry-After or X-RateLimit-Reset), if it said."""
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("X-RateLimit-Reset")
+    if reset:
         try:
-            response = requests.get(url, timeout=15)
+            reset = float(reset)
+        except ValueError:
+            return None
+        # Either an epoch timestamp or a number of seconds, depending on the server
+        return max(0.0, reset - time.time()) if reset > 1e9 else reset
+    return None
+
+
+def _back_off(url: str, headers, delay: float):
+    """Pause the bucket after a 429/503, for as long as the server asked or `delay`."""
+    wait = _retry_after_seconds(headers) or delay
+    print(f"      🐢 Rate limited on {url}, waiting {wait:.1f}s...")
+    _BUCKET.pause(wait)
+
+
+def _note_rate_limit(headers):
+    """If the server reports its quota is spent, pause until it resets."""
+    if headers.get("X-RateLimit-Remaining") == "0":
+        wait = _retry_after_seconds(headers)
+        if wait:
+            _BUCKET.pause(wait)
+
+
+# One HTTP session for every synchronous fetch. requests.get() opens a fresh
+# TCP + TLS connection per call; the session keeps connections to the catalogue
+# alive and reuses them. Connection errors, timeouts and 500/502/504 are retried
+# in the adapter (exponential backoff: 0.5s, 1s, 2s); 429/503 are handled by
+# fetch_html() itself so the wait is shared through the token bucket.
+_HEADERS = {"Accept-Encoding": "gzip, deflate", "User-Agent": "mcgill-course-crafter/0.1"}
+_SESSION = requests.Session()
+_SESSION.headers.update(_HEADERS)
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 504)),
+))
+
+
+# Bodies are decoded as UTF-8 (what the catalogue serves) rather than through
+# response.text, which runs charset detection over the whole page when the
+# server doesn't name a charset. Course pages are ~50 KB, so anything past
+# MAX_HTML_BYTES is not a course page and is abandoned mid-download.
+MAX_HTML_BYTES = 2 * 1024 * 1024
+_READ_CHUNK = 64 * 1024
+
+
+def _too_large(url: str) -> ValueError:
+    return ValueError(f"{url}: response is larger than {MAX_HTML_BYTES} bytes")
+
+
+def _read_html(response: requests.Response, url: str) -> str:
+    """Read a streamed (already decompressed) response body, capped at MAX_HTML_BYTES."""
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > MAX_HTML_BYTES:
+        raise _too_large(url)
+    body = bytearray()
+    for chunk in response.iter_content(_READ_CHUNK):
+        body += chunk
+        if len(body) > MAX_HTML_BYTES:
+            raise _too_large(url)
+    return body.decode("utf-8", errors="replace")
+
+
+async def _read_html_async(response: aiohttp.ClientResponse, url: str) -> str:
+    """Async _read_html()."""
+    if response.content_length and response.content_length > MAX_HTML_BYTES:
+        raise _too_large(url)
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(_READ_CHUNK):
+        body += chunk
+        if len(body) > MAX_HTML_BYTES:
+            raise _too_large(url)
+    return body.decode("utf-8", errors="replace")
+
+
+def fetch_html(url: str) -> str:
+    """Fetch HTML content from a URL, within the shared rate limit."""
+    for delay in (*RATE_LIMIT_BACKOFF, None):
+        _BUCKET.acquire()
+        with _SESSION.get(url, timeout=15, stream=True) as response:
+            if response.status_code in (429, 503) and delay is not None:
+                _back_off(url, response.headers, delay)
+                continue
+            _note_rate_limit(response.headers)
             response.raise_for_status()
-            time.sleep(0.5)  # Be polite and avoid overwhelming the server
-            return response.text
-        except requests.exceptions.Timeout:
-            if attempt < retries - 1:
-                print(f"      ⏱️  Timeout, retrying ({attempt + 1}/{retries})...")
-                time.sleep(2)
-            else:
-                raise
-        except requests.exceptions.RequestException as e:
-            if attempt < retries - 1:
-                print(f"      ⚠️  Network error, retrying ({attempt + 1}/{retries})...")
-                time.sleep(2)
-            else:
-                raise
-    return ""
+            return _read_html(response, url)
+
+# Concurrent fetching for the bulk scrapes. Course pages are pure network wait,
+# so instead of fetching thousands of them one after another we keep a bounded
+# number in flight: FETCH_CONCURRENCY requests overall, at most FETCH_PER_HOST open
+# connections to the catalogue. The token bucket above sets the overall pace.
+# Pages are fetched FETCH_WINDOW at a time so a full scrape never holds every
+# page's HTML in memory at once.
+FETCH_CONCURRENCY = 16
+FETCH_PER_HOST = 8
+FETCH_WINDOW = 200
+
+
+def _conditional_headers(etag: str | None, last_modified: str | None) -> dict:
+    """If-None-Match / If-Modified-Since headers for the validators a page was last served with."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+async def fetch_page_async(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore,
+                           etag: str | None = None, last_modified: str | None = None,
+                           retries: int = 3) -> tuple[int, str, str | None, str | None]:
+    """Conditional fetch: returns (status, html, etag, last_modified).
+
+    Given the validators from the previous fetch, the catalogue answers 304 Not
+    Modified with an empty body when the page hasn't changed. The returned
+    validators are the ones to send next time (the old ones if a 304 didn't repeat them).
+    """
+    headers = _conditional_headers(etag, last_modified)
+    async with semaphore:
+        for attempt in range(retries):
+            try:
+                for delay in (*RATE_LIMIT_BACKOFF, None):
+                    await _BUCKET.acquire_async()
+                    async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                        if response.status in (429, 503) and delay is not None:
+                            _back_off(url, response.headers, delay)
+                            continue
+                        _note_rate_limit(response.headers)
+                        response.raise_for_status()
+                        new_etag = response.headers.get("ETag", etag)
+                        new_last_modified = response.headers.get("Last-Modified", last_modified)
+                        if response.status == 304:
+                            return 304, "", new_etag, new_last_modified
+                        html = await _read_html_async(response, url)
+                        return response.status, html, new_etag, new_last_modified
+            except asyncio.TimeoutError:
+                if attempt < retries - 1:
+                    print(f"      ⏱️  Timeout, retrying ({attempt + 1}/{retries})...")
+                    await asyncio.sleep(2)
+                else:
+                    raise
+            except aiohttp.ClientError as e:
+                # A 429/503 only gets here once RATE_LIMIT_BACKOFF is used up; retrying
+                # it would start the whole backoff sequence over again
+                if isinstance(e, aiohttp.ClientResponseError) and e.status in (429, 503):
+                    raise
+                if attempt < retries - 1:
+                    print(f"      ⚠️  Network error, retrying ({attempt + 1}/{retries})...")
+                    await asyncio.sleep(2)
+                else:
+                    raise
+
+
+async def fetch_html_async(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore, retries: int = 3) -> str:
+    """Async counterpart of fetch_html(), gated by the shared semaphore and rate limit."""
+    _, html, _, _ = await fetch_page_async(session, url, semaphore, retries=retries)
+    return html
+
+
+async def _fetch_all_html(urls: list[str], validators: list[tuple] | None = None) -> list:
+    """Fetch urls concurrently. Each result is the page's HTML, or the exception it raised.
+
+    With validators (one (etag, last_modified) pair per url), the requests are
+    conditional and each result is fetch_page_async()'s tuple instead of the HTML.
+    """
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit_per_host=FETCH_PER_HOST)
+    async with aiohttp.ClientSession(connector=connector, headers=_HEADERS) as session:
+        if validators is None:
+            jobs = [fetch_html_async(session, url, semaphore) for url in urls]
+        else:
+            jobs = [fetch_page_async(session, url, semaphore, etag, last_modified)
+                    for url, (etag, last_modified) in zip(urls, validators)]
+        return await asyncio.gather(*jobs, return_exceptions=True)
+
+
+def fetch_many_html(urls: list[str]):
+    """Yield (url, html) for every url, in order, fetching FETCH_WINDOW pages at a time.
+
+    A page that failed after its retries comes back as the exception instead of HTML,
+    so the caller can count it as an error and carry on with the rest.
+    """
+    for start in range(0, len(urls), FETCH_WINDOW):
+        window = urls[start:start + FETCH_WINDOW]
+        yield from zip(window, asyncio.run(_fetch_all_html(window)))
+
+
+def fetch_many_pages(urls: list[str], validators: list[tuple]):
+    """Conditional fetch_many_html(): yield (url, (status, html, etag, last_modified)).
+
+    validators[i] is the (etag, last_modified) pair urls[i] was last served with
+    (either may be None). Unchanged pages come back as status 304 with no HTML.
+    """
+    for start in range(0, len(urls), FETCH_WINDOW):
+        window = urls[start:start + FETCH_WINDOW]
+        yield from zip(window, asyncio.run(_fetch_all_html(window, validators[start:start + FETCH_WINDOW])))
+
 
 def parse_course_list(html: str) -> list[str]:
     """Parse the main course list page to extract course links."""
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, 'lxml', parse_only=_ANCHORS_ONLY)
     course_links = []
+    seen = set()  # normalized hrefs already added, so duplicates are skipped in the same pass
 
     # look for anchor tags whose href starts with "/courses/<some-course>"
     for a in soup.select('a[href^="/courses/"]'):
         href = a['href']
         # match lowercase or uppercase course codes + optional index.html
-        if re.match(r"^/courses/[A-Za-z]{4}-\d{3}(/index\.html)?$", href):
+        if _LIST_LINK_RE.match(href):
             # normalize URL (strip trailing /index.html)
-            href = re.sub(r"/index\.html$", "", href)
-            course_links.append(urljoin(BASE_URL, href))
-    return list(set(course_links))  # Remove duplicates
+            href = _INDEX_HTML_RE.sub("", href)
+            if href not in seen:
+                seen.add(href)
+                course_links.append(urljoin(BASE_URL, href))
+    return course_links  # page order, duplicates removed
 
 def parse_course_page(html: str, url: str = "") -> dict:
     """Parse an individual course page to extract course details."""
-    soup = BeautifulSoup(html, 'html.parser')
+    # An empty body would make lxml raise; treat it as a page with nothing on it
+    doc = lxml_html.document_fromstring(html if html and html.strip() else "<html></html>")
     course_data = {}
 
-    # Extract course code and title
-    title_tag = soup.find('title')
-    if title_tag:
-        # Try first pattern: "COMP 273. Introduction to Computer Systems. | McGill..."
-        match = re.match(r'([A-Z]{3,4}[- ]?\d{3}[A-Z]?)\.\s+(.+?)\s+\|', title_tag.text.strip())
-        if match:
-            course_data['id'] = match.group(1).replace('-', ' ')   # e.g., "COMP 273"
-            course_data['title'] = match.group(2).strip()  # e.g., "Introduction to Computer Systems."
-        else:
-            # Try alternate pattern: "COMP 273 - Introduction to Computer Systems | McGill..."
-            match = re.match(r'([A-Z]{3,4}[- ]?\d{3}[A-Z]?)\s*[-–]\s*(.+?)\s+\|', title_tag.text.strip())
-            if match:
-                course_data['id'] = match.group(1).replace('-', ' ')
-                course_data['title'] = match.group(2).strip()
-
-    # Fallback: Extract ID from URL if not found in page
-    if 'id' not in course_data and url:
-        match = re.search(r'/courses/([a-z]{3,4})-(\d{3}[a-z]?)/?', url, re.IGNORECASE)
+    # Course code: the URL is canonical (/courses/comp-273/), so take it from there
+    if url:
+        match = _URL_ID_RE.search(url)
         if match:
             dept, num = match.groups()
             course_data['id'] = f"{dept.upper()} {num.upper()}"
 
+    # Title from the <title> tag, in either of the catalogue's two formats:
+    #   "COMP 273. Introduction to Computer Systems. | McGill..."
+    #   "COMP 273 - Introduction to Computer Systems | McGill..."
+    title_tag = _first(_TITLE_XPATH, doc)
+    if title_tag is not None:
+        match = _TITLE_RE.match(title_tag.text_content().strip())
+        if match:
+            course_data['title'] = match.group(2).strip()  # e.g., "Introduction to Computer Systems."
+            # No usable URL: fall back to the code in the title
+            course_data.setdefault('id', match.group(1).replace('-', ' '))   # e.g., "COMP 273"
+
     # Set default values for required fields if they're missing
     if 'id' not in course_data:
         course_data['id'] = "UNKNOWN"
@@ -81,18 +404,18 @@ def parse_course_page(html: str, url: str = "") -> dict:
 
 
     # Extract description
-    desc_tag = soup.find('div', class_='section__content')
-    if desc_tag:
-        course_data['description'] = desc_tag.text.strip()
+    desc_tag = _first(_DESC_XPATH, doc)
+    if desc_tag is not None:
+        course_data['description'] = desc_tag.text_content().strip()
     else:
         course_data['description'] = "No description available"  # Default value
 
 
     # Extract credits
-    credits_tag = soup.find('div', class_='text detail-credits')
-    if credits_tag:
-        credits_text = credits_tag.get_text(strip=True)  # e.g., "Credits: 3.0"
-        match = re.search(r'(\d+\.?\d*)', credits_text)
+    credits_tag = _first(_CREDITS_XPATH, doc)
+    if credits_tag is not None:
+        credits_text = _stripped_text(credits_tag)  # e.g., "Credits:3.0"
+        match = _CREDITS_RE.search(credits_text)
         if match:
             course_data['credits'] = float(match.group(1))
         else:
@@ -102,11 +425,11 @@ def parse_course_page(html: str, url: str = "") -> dict:
         
   
     # Extract "offered by"
-    offered_by_tag = soup.find('div', class_='text detail-offered_by margin--tiny')
-    if offered_by_tag:
-        value_span = offered_by_tag.find('span', class_='value')
-        if value_span:
-            course_data['offered_by'] = value_span.text.strip()
+    offered_by_tag = _first(_OFFERED_BY_XPATH, doc)
+    if offered_by_tag is not None:
+        value_span = _first(_VALUE_SPAN_XPATH, offered_by_tag)
+        if value_span is not None:
+            course_data['offered_by'] = value_span.text_content().strip()
     # Add this default value
     else:
         course_data['offered_by'] = f"{course_data.get('id', '').split()[0]} Department"
@@ -114,9 +437,9 @@ def parse_course_page(html: str, url: str = "") -> dict:
 
     # Extract offerings
     offerings = {'offered_fall': False, 'offered_winter': False, 'offered_summer': False}
-    terms_tag = soup.select_one('div.detail-terms_offered span.value')
-    if terms_tag:
-        terms_text = terms_tag.get_text(strip=True)
+    terms_tag = _first(_TERMS_XPATH, doc)
+    if terms_tag is not None:
+        terms_text = _stripped_text(terms_tag)
         if 'Fall' in terms_text:
             offerings['offered_fall'] = True
         if 'Winter' in terms_text:
@@ -126,56 +449,47 @@ def parse_course_page(html: str, url: str = "") -> dict:
     course_data.update(offerings)
 
 
-    # Extract prerequisites
+    # Extract prerequisites and corequisites
     prereq_edges = []
+    coreq_edges = []
     prereq_text = ""  # <-- Initialize safely
+    coreq_text = ""
     
-    # First, try to find in detail-note_text (newer format)
-    note_div = soup.find('div', class_='detail-note_text')
-    if note_div:
-        for li in note_div.find_all('li'):
-            li_text = li.get_text(strip=True)
-            # Match various prerequisite patterns
-            if re.match(r'Prerequisite[s()\s]*:', li_text, re.I):
+    # First, try to find in detail-note_text (newer format). One pass over its
+    # <li>s picks up both lines.
+    note_div = _first(_NOTE_XPATH, doc)
+    if note_div is not None:
+        for li in _LI_XPATH(note_div):
+            li_text = _stripped_text(li)
+            # Match various prerequisite / corequisite patterns
+            if not prereq_text and _PREREQ_LI_RE.match(li_text):
                 prereq_text = li_text
+            if not coreq_text and _COREQ_LI_RE.match(li_text):
+                coreq_text = li_text
+            if prereq_text and coreq_text:
+                break
+    
+    # Fallback: old method — first matching text node for whichever is still missing
+    if not prereq_text or not coreq_text:
+        for text_node in _REQUISITE_TEXT_XPATH(doc):
+            if not prereq_text and _PREREQ_RE.search(text_node):
+                prereq_text = _text_node_parent(text_node).text_content().strip()
+            if not coreq_text and _COREQ_RE.search(text_node):
+                coreq_text = _text_node_parent(text_node).text_content().strip()
+            if prereq_text and coreq_text:
                 break
     
-    # Fallback: old method
-    if not prereq_text:
-        prereq_tag = soup.find(text=re.compile(r'Prerequisite[\s(s)]*:', re.I))
-        if prereq_tag:
-            prereq_text = prereq_tag.parent.text.strip()
+    course_id = course_data.get('id')
     
     # Extract course codes from prereq text
     if prereq_text:
-        prereq_courses = re.findall(r'([A-Z]{3,4}[- ]?\d{3})', prereq_text)
-        for prereq in prereq_courses:
-            prereq_edges.append({'src_course_id': prereq, 'dst_course_id': course_data.get('id'), 'kind': 'prereq',})
-    
-    # Extract corequisites (if any)
-    coreq_edges = []
-    coreq_text = ""  # <-- Initialize safely
-    
-    # First, try to find in detail-note_text (newer format)
-    if note_div:
-        for li in note_div.find_all('li'):
-            li_text = li.get_text(strip=True)
-            if re.match(r'Corequisite[s()\s]*:', li_text, re.I):
-                coreq_text = li_text
-                break
-    
-    # Fallback: old method
-    if not coreq_text:
-        coreq_tags = soup.find_all(text=re.compile(r'Corequisite[\s(s)]*:', re.I))
-        for coreq_tag in coreq_tags:
-            coreq_text = coreq_tag.parent.text.strip()
-            break
+        prereq_edges = [{'src_course_id': prereq, 'dst_course_id': course_id, 'kind': 'prereq'}
+                        for prereq in _COURSE_CODE_RE.findall(prereq_text)]
     
     # Extract course codes from coreq text
     if coreq_text:
-        coreq_courses = re.findall(r'([A-Z]{3,4}[- ]?\d{3})', coreq_text)
-        for coreq in coreq_courses:
-            coreq_edges.append({'src_course_id': coreq, 'dst_course_id': course_data.get('id'), 'kind': 'coreq',})
+        coreq_edges = [{'src_course_id': coreq, 'dst_course_id': course_id, 'kind': 'coreq'}
+                       for coreq in _COURSE_CODE_RE.findall(coreq_text)]
     
     # Add to output
     course_data['prereq_edges'] = prereq_edges
@@ -188,43 +502,101 @@ def get_all_course_links() -> list[str]:
     """Get all course links directly from the main catalog page."""
     print("Fetching main catalog page...")
     main_html = fetch_html(BASE_URL)
-    soup = BeautifulSoup(main_html, 'html.parser')
+    soup = BeautifulSoup(main_html, 'lxml', parse_only=_ANCHORS_ONLY)
     
     course_links = []
     seen_courses = set()  # Track unique course codes to avoid duplicates
     
-    # Look for all links on the page
-    for a in soup.find_all('a', href=True):
+    # Only links under /courses/ — the attribute-prefix filter runs before Python sees the tags
+    for a in soup.select('a[href^="/courses/"]'):
         href = a['href']
         
-        # Check if it matches our course pattern - be more specific
-        if re.match(r"^/courses/[a-z]{3,4}-\d{3}[a-z]?(/index\.html)?$", href, re.IGNORECASE):
-            # Extract the course code from the URL (e.g., "comp-202" -> "COMP 202")
-            match = re.search(r'/courses/([a-z]{3,4})-(\d{3}[a-z]?)/?', href, re.IGNORECASE)
-            if match:
-                dept, num = match.groups()
-                course_code = f"{dept.upper()} {num}"
-                
-                # Skip if we've seen this course already
-                if course_code in seen_courses:
-                    continue
-                    
-                seen_courses.add(course_code)
-                full_url = urljoin(BASE_URL, href)
-                course_links.append(full_url)
-                
-                # Print first 5 courses for debugging
-                if len(course_links) <= 5:
-                    print(f"Found course: {course_code} - {full_url}")
+        # One match both checks our course pattern and pulls out the course code
+        # (e.g., "comp-202" -> "COMP 202")
+        match = _CATALOG_LINK_RE.match(href)
+        if not match:
+            continue
+        dept, num = match.groups()
+        course_code = f"{dept.upper()} {num}"
+        
+        # Skip if we've seen this course already
+        if course_code in seen_courses:
+            continue
+            
+        seen_courses.add(course_code)
+        course_links.append(urljoin(BASE_URL, href))
     
+    # Print first 5 courses for debugging — once, after the loop, so the scan itself
+    # does no I/O
+    if course_links:
+        print("\n".join(f"Found course: {url}" for url in course_links[:5]))
     print(f"Total unique courses found: {len(course_links)}")
     return course_links
 
+# Scraped courses are written in batches: one SELECT to see which IDs already
+# exist, then one bulk INSERT for the new ones and one bulk UPDATE (by primary
+# key) for the rest, and a single commit — instead of a lookup, a flush and
+# eventually a commit per course.
+SCRAPE_WRITE_BATCH = 500
+_COURSE_FIELDS = ('title', 'description', 'credits', 'offered_by', 'offered_fall',
+                  'offered_winter', 'offered_summer', 'prereq_text', 'coreq_text')
+_NEW_COURSE_DEFAULTS = {
+    'title': 'Unknown', 'description': '', 'credits': 0.0, 'offered_by': '',
+    'offered_fall': False, 'offered_winter': False, 'offered_summer': False,
+    'prereq_text': '', 'coreq_text': '',
+}
+
+
+def _write_course_batch(session, batch: dict) -> tuple[int, int]:
+    """Insert or update a batch of parsed courses ({course_id: data}) and commit. Returns (updated, created)."""
+    existing = set(session.scalars(select(Course.id).where(Course.id.in_(list(batch)))))
+    new_rows = []
+    update_rows = []
+    for course_id, data in batch.items():
+        if course_id in existing:
+            # Fields the page didn't yield keep their current value, as before
+            update_rows.append({'id': course_id, **{k: data[k] for k in _COURSE_FIELDS if k in data}})
+        else:
+            new_rows.append({'id': course_id, **{k: data.get(k, default) for k, default in _NEW_COURSE_DEFAULTS.items()}})
+    if new_rows:
+        session.execute(insert(Course), new_rows)
+    if update_rows:
+        session.execute(update(Course), update_rows)
+    session.commit()
+    return len(update_rows), len(new_rows)
+
+
+# scrape_and_update_db() appends each parsed course to a JSONL file (one course
+# per line) as pages come in, and only loads that file into the DB once the scrape
+# is done. Fetching never waits on the database, and if a run dies half-way the
+# next one picks up from the file instead of re-fetching every page. The file is
+# removed once everything in it has been written to the DB.
+SCRAPE_RESULTS_PATH = pathlib.Path(os.getenv("SCRAPE_RESULTS_PATH", pathlib.Path(__file__).parent / "cache" / "courses.jsonl"))
+
+
+def _read_scrape_results(path: pathlib.Path) -> dict:
+    """Read {course_id: data} back from a results file. Later lines win, like re-scraping did."""
+    results = {}
+    if not path.exists():
+        return results
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                data = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # half-written last line from an interrupted run
+            results[data['id']] = data
+    return results
+
+
 def scrape_and_update_db():
     """Scrape all courses and update the database."""
     from db_connection import Session
     from db_setup import Course
+    from ensure_columns import ensure_columns
+    from rag_layer import invalidate_course_snapshot
     
+    ensure_columns()  # the etag/last_modified validators are written below
     print("=" * 60)
     print("McGill Course Scraper")
     print("=" * 60)
@@ -237,21 +609,30 @@ def scrape_and_update_db():
         print("No courses found! Check the scraper.")
         return
     
-    print(f"\nStarting to scrape {total} courses...")
+    # Resume: pages already saved by an interrupted run aren't fetched again
+    results = _read_scrape_results(SCRAPE_RESULTS_PATH)
+    if results:
+        done_urls = {data['url'] for data in results.values()}
+        course_links = [url for url in course_links if url not in done_urls]
+        print(f"\nResuming: {len(results)} courses already in {SCRAPE_RESULTS_PATH}")
+    
+    print(f"\nStarting to scrape {len(course_links)} courses...")
     print("-" * 60)
     
     updated = 0
     created = 0
     errors = 0
     
-    with Session() as session:
-        for i, url in enumerate(course_links, 1):
+    SCRAPE_RESULTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(SCRAPE_RESULTS_PATH, "ab") as out:
+        for i, (url, html) in enumerate(fetch_many_html(course_links), 1):
             try:
                 # Progress update every 50 courses
                 if i % 50 == 0 or i == 1:
-                    print(f"[{i}/{total}] Processing... ({100*i//total}%)")
+                    print(f"[{i}/{len(course_links)}] Processing... ({100*i//len(course_links)}%)")
                 
-                html = fetch_html(url)
+                if isinstance(html, Exception):
+                    raise html  # fetch failed after retries
                 data = parse_course_page(html, url)
                 
                 course_id = data.get('id')
@@ -260,50 +641,41 @@ def scrape_and_update_db():
                     errors += 1
                     continue
                 
-                # Check if course exists
-                course = session.query(Course).filter_by(id=course_id).first()
-                
-                if course:
-                    # Update existing course
-                    course.title = data.get('title', course.title)
-                    course.description = data.get('description', course.description)
-                    course.credits = data.get('credits', course.credits)
-                    course.offered_by = data.get('offered_by', course.offered_by)
-                    course.offered_fall = data.get('offered_fall', course.offered_fall)
-                    course.offered_winter = data.get('offered_winter', course.offered_winter)
-                    course.offered_summer = data.get('offered_summer', course.offered_summer)
-                    course.prereq_text = data.get('prereq_text', course.prereq_text)
-                    course.coreq_text = data.get('coreq_text', course.coreq_text)
-                    updated += 1
-                else:
-                    # Create new course
-                    course = Course(
-                        id=course_id,
-                        title=data.get('title', 'Unknown'),
-                        description=data.get('description', ''),
-                        credits=data.get('credits', 0.0),
-                        offered_by=data.get('offered_by', ''),
-                        offered_fall=data.get('offered_fall', False),
-                        offered_winter=data.get('offered_winter', False),
-                        offered_summer=data.get('offered_summer', False),
-                        prereq_text=data.get('prereq_text', ''),
-                        coreq_text=data.get('coreq_text', ''),
-                    )
-                    session.add(course)
-                    created += 1
-                
-                # Commit every 100 courses
-                if i % 100 == 0:
-                    session.commit()
-                    print(f"  ✓ Committed batch (updated: {updated}, created: {created})")
+                data['url'] = url  # so a resumed run knows this page is done
+                out.write(orjson.dumps(data) + b"\n")
+                results[course_id] = data
                     
             except Exception as e:
                 print(f"  ❌ Error scraping {url}: {e}")
                 errors += 1
                 continue
-        
-        # Final commit
-        session.commit()
+    
+    # Load everything into the DB, SCRAPE_WRITE_BATCH courses per statement/commit
+    print(f"\nWriting {len(results)} courses to the database...")
+    items = list(results.items())
+    failed = 0
+    with Session() as session:
+        for start in range(0, len(items), SCRAPE_WRITE_BATCH):
+            batch = dict(items[start:start + SCRAPE_WRITE_BATCH])
+            try:
+                batch_updated, batch_created = _write_course_batch(session, batch)
+                updated += batch_updated
+                created += batch_created
+                print(f"  ✓ Committed batch (updated: {updated}, created: {created})")
+            except Exception as e:
+                session.rollback()
+                print(f"  ❌ Error writing batch of {len(batch)} courses: {e}")
+                failed += len(batch)
+    errors += failed
+    # The server's disk snapshot of the courses table predates these writes
+    invalidate_course_snapshot()
+    
+    # Keep the file if anything didn't make it in, so a rerun can retry the load
+    # without scraping again
+    if failed:
+        print(f"  ⚠️  Kept {SCRAPE_RESULTS_PATH} — rerun to retry the failed batches")
+    else:
+        SCRAPE_RESULTS_PATH.unlink(missing_ok=True)
     
     print("-" * 60)
     print(f"✅ Scraping complete!")
@@ -317,7 +689,10 @@ def scrape_missing_only():
     from db_connection import Session
     from db_setup import Course
     from sqlalchemy import or_
+    from ensure_columns import ensure_columns
+    from rag_layer import invalidate_course_snapshot
     
+    ensure_columns()
     print("=" * 60)
     print("🔍 McGill Course Scraper - UPDATE MISSING DATA ONLY")
     print("=" * 60)
@@ -347,16 +722,16 @@ def scrape_missing_only():
     skipped = 0
     errors = 0
     
+    # Build URLs from course IDs (e.g., "COMP 250" -> "comp-250")
+    urls = [f"{BASE_URL}{course_slug(course_id)}/" for course_id in course_ids]
+
     with Session() as session:
-        for i, course_id in enumerate(course_ids, 1):
-            # Build URL from course ID (e.g., "COMP 250" -> "comp-250")
-            url_slug = course_id.lower().replace(' ', '-')
-            url = f"https://coursecatalogue.mcgill.ca/courses/{url_slug}/"
-            
-            print(f"({i}/{total}) 📄 Fetching {course_id}...")
+        for i, (course_id, (url, html)) in enumerate(zip(course_ids, fetch_many_html(urls)), 1):
+            print(f"({i}/{total}) 📄 Fetched {course_id}")
             
             try:
-                html = fetch_html(url)
+                if isinstance(html, Exception):
+                    raise html  # fetch failed after retries
                 data = parse_course_page(html, url)
                 
                 # Check if we got valid data
@@ -366,7 +741,7 @@ def scrape_missing_only():
                     continue
                 
                 # Update existing course
-                course = session.query(Course).filter_by(id=course_id).first()
+                course = session.get(Course, course_id)
                 if course:
                     old_title = course.title
                     course.title = data.get('title', course.title)
@@ -396,6 +771,7 @@ def scrape_missing_only():
         
         # Final commit
         session.commit()
+    invalidate_course_snapshot()
     
     print("-" * 60)
     print(f"✅ Update complete!")
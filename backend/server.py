@@ -1,21 +1,23 @@
 # This is a simple Python API using FastAPI.
 # Later build a TypeScript React frontend that talks to this Python API.
+import functools
+import hashlib
 import os
 import pathlib
+import time
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict
 import jwt  # PyJWT: decodes and verifies JWT tokens
 from jwt import PyJWKClient  # Fetches public keys from Supabase's JWKS endpoint
-from qa_agent import generate_answer
+from qa_agent import generate_answer_async, stream_answer
 from db_connection import Session as DBSession
 from db_setup import Course, UserProfile, UserCourse
-from dotenv import load_dotenv
-
-load_dotenv()
-
-
+from ensure_columns import ensure_columns
+from rag_layer import course_cache_generation
 import threading
 
 # Track whether the vector store is ready (for /query to check)
@@ -30,12 +32,34 @@ def _build_vector_store_sync():
         print("[STARTUP] Vector store built successfully")
     except Exception as e:
         print(f"[STARTUP] ERROR building vector store: {e}")
+    _warm_up_sync()
+
+
+def _warm_up_sync():
+    """Load the embedding model and course tables before the first query needs them.
+
+    Without this, whichever request comes first pays for loading the model (seconds)
+    on its own latency. /query waits on vector_store_ready, which is set here even
+    if warming fails — the first search then just loads things itself.
+    """
+    try:
+        from rag_layer import warm_up
+        warm_up()
+        print("[STARTUP] Embedding model and course tables loaded")
+    except Exception as e:
+        print(f"[STARTUP] ERROR warming up: {e}")
     finally:
         vector_store_ready.set()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Columns added to db_setup.py since the database was created (every ORM load
+    # of Course selects them), added here so a deploy never needs a manual migration
+    try:
+        await run_in_threadpool(ensure_columns)
+    except Exception as e:
+        print(f"[STARTUP] ERROR ensuring columns: {e}")
     # On startup: build ChromaDB vector store if it doesn't exist yet
     # (Railway has an ephemeral filesystem, so this runs on every deploy)
     chroma_sqlite = pathlib.Path(__file__).parent / "chroma_db" / "chroma.sqlite3"
@@ -45,7 +69,7 @@ async def lifespan(app: FastAPI):
         thread.start()
     else:
         print("[STARTUP] ChromaDB already exists, skipping build")
-        vector_store_ready.set()
+        threading.Thread(target=_warm_up_sync, daemon=True).start()
     yield
 
 
@@ -112,9 +136,7 @@ def build_user_context(user_id: str) -> str | None:
     """
     with DBSession() as session:
         # Load profile
-        profile = session.query(UserProfile).filter(
-            UserProfile.user_id == user_id
-        ).first()
+        profile = session.get(UserProfile, user_id)
 
         if not profile:
             return None  # User exists in auth but hasn't done onboarding yet
@@ -161,56 +183,120 @@ app.add_middleware(
 
 @app.post("/query")
 async def handle_query(request: Request, body: QueryRequest):
+    # This handler runs on the event loop, so anything that blocks (waiting on the
+    # build thread, the JWKS fetch, the profile query) goes to the threadpool —
+    # otherwise one slow request would stall every other request on the server.
+
     # Wait up to 120s for vector store to finish building (first deploy only)
-    if not vector_store_ready.wait(timeout=120):
+    if not vector_store_ready.is_set() and not await run_in_threadpool(vector_store_ready.wait, 120):
         raise HTTPException(status_code=503, detail="Server is still starting up. Please try again in a minute.")
     try:
         # Try to identify the user (returns None for anonymous users)
-        user_id = get_user_id_from_token(request)
+        user_id = await run_in_threadpool(get_user_id_from_token, request)
 
         # If user is signed in, load their profile for personalized responses
         user_context = None
         if user_id:
-            user_context = build_user_context(user_id)
+            user_context = await run_in_threadpool(build_user_context, user_id)
 
         # Pass user context to the LLM (None for anonymous = no personalization)
-        # generate_answer now returns {"answer": str, "sources": list}
-        result = generate_answer(body.question, user_context=user_context)
+        # generate_answer_async returns {"answer": str, "sources": list}. Awaiting it
+        # lets retrieval, DB lookups and the LLM call overlap instead of running serially.
+        result = await generate_answer_async(body.question, user_context=user_context)
         return {"answer": result["answer"], "sources": result["sources"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/courses/{course_id}")
-def get_course(course_id: str):
-    """Retrieve course details by course ID."""
-    
+@app.post("/query/stream")
+def handle_query_stream(request: Request, body: QueryRequest):
+    """Same as /query, but streams the answer text as the LLM writes it (no sources).
 
+    Declared as a plain def: FastAPI runs it in a worker thread, and StreamingResponse
+    iterates the sync generator in the threadpool too, so the event loop never blocks.
+    """
+    if not vector_store_ready.wait(timeout=120):
+        raise HTTPException(status_code=503, detail="Server is still starting up. Please try again in a minute.")
+
+    user_id = get_user_id_from_token(request)
+    user_context = build_user_context(user_id) if user_id else None
+    return StreamingResponse(stream_answer(body.question, user_context=user_context), media_type="text/plain")
+
+
+# /courses/{course_id} responses. The catalogue changes at most once a day (when
+# the scraper runs), so each course is kept in an LRU, and browsers are told to
+# reuse it for an hour. The ETag is a hash of the record itself, so a client's copy
+# only validates while the data is unchanged.
+#
+# The scraper and update_prereq_text write from their own processes, so the LRU
+# can't be told about every change. Its entries are keyed on the current
+# COURSE_CACHE_MAX_AGE window (and on rag_layer's refresh counter): a course is
+# re-read from the DB at least once per window, the same hour browsers cache it.
+COURSE_RESPONSE_CACHE_SIZE = 4096
+COURSE_CACHE_MAX_AGE = 3600
+COURSE_CACHE_CONTROL = f"public, max-age={COURSE_CACHE_MAX_AGE}"
+
+
+class CourseOut(BaseModel):
+    """Response body of /courses/{course_id}, read straight off the Course row.
+
+    Declaring it as the endpoint's return type lets FastAPI serialize it with
+    pydantic-core (Rust) directly to JSON bytes, instead of building a dict in
+    Python and running it through the generic JSON encoder.
+    """
+    model_config = ConfigDict(from_attributes=True)
+
+    id: str
+    title: str
+    description: str
+    credits: float | None  # DECIMAL column → float
+    offered_by: str | None
+    offered_fall: bool | None
+    offered_winter: bool | None
+    offered_summer: bool | None
+    prereq_text: str | None
+    coreq_text: str | None
+    # Add other relevant fields as needed
+
+
+@functools.lru_cache(maxsize=COURSE_RESPONSE_CACHE_SIZE)
+def _course_response(course_id: str, freshness: tuple[int, int]) -> tuple[CourseOut, str]:
+    """Load a course as (response body, ETag). Raises a 404 for unknown IDs.
+
+    `freshness` only takes part in the cache key (see _course_freshness()).
+    Exceptions aren't cached by lru_cache, so a course added after a miss is
+    found on the next request.
+    """
     with DBSession() as session:
-        course = session.query(Course).filter(Course.id == course_id).first()
+        # Primary-key lookup: checks the session's identity map before issuing SQL
+        course = session.get(Course, course_id)
         if course is None:
             raise HTTPException(status_code=404, detail="Course not found")
-        return {
-            "id": course.id,
-            "title": course.title,
-            "description": course.description,
-            "credits": float(course.credits),
-            "offered_by": course.offered_by,
-            "offered_fall": course.offered_fall,
-            "offered_winter": course.offered_winter,
-            "offered_summer": course.offered_summer,
-            "prereq_text": course.prereq_text,
-            "coreq_text": course.coreq_text,
-            
-            # Add other relevant fields as needed
-        }
+        body = CourseOut.model_validate(course)
+    digest = hashlib.blake2b(body.model_dump_json().encode(), digest_size=8).hexdigest()
+    return body, f'"{digest}"'
+
+
+def _course_freshness() -> tuple[int, int]:
+    """Cache-key part that changes on every course refresh and every COURSE_CACHE_MAX_AGE window."""
+    return course_cache_generation(), int(time.time() // COURSE_CACHE_MAX_AGE)
+
+
+@app.get("/courses/{course_id}")
+def get_course(course_id: str, request: Request, response: Response) -> CourseOut:
+    """Retrieve course details by course ID."""
+    body, etag = _course_response(course_id, _course_freshness())
+    headers = {"ETag": etag, "Cache-Control": COURSE_CACHE_CONTROL}
+
+    # The client already has this exact version: answer with headers only
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in (t.strip() for t in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return body
     
 @app.get("/") # Root endpoint to check if the API is running
 def root():
     return {"message": "CourseCraft API is running!"}
 
-# more get endpoints can be added here as needed
-# @app.get("/courses/{course_id}")
-# def get_course(course_id: str):
-# do this one yourself on ipad
-
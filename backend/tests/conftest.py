@@ -0,0 +1,18 @@
+# Shared setup for the backend tests: run with `python -m pytest backend/tests`.
+#
+# The backend modules import each other as top-level modules (they're run from
+# backend/), so that directory goes on sys.path. None of these tests touch
+# Postgres, Chroma or the embedding model — those boundaries are replaced per test
+# — but importing db_connection / qa_agent still needs these variables set.
+import os
+import pathlib
+import sys
+import tempfile
+
+BACKEND_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+# Keep the course snapshot out of backend/cache
+os.environ.setdefault("COURSE_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "courses.pkl"))
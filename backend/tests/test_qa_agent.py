@@ -0,0 +1,45 @@
+# The blocking answer wrappers: a deterministic answer must not wait for the
+# retrieval that was started alongside it. Retrieval and the course lookups are
+# replaced with fakes, so no DB, vector store or LLM is involved.
+import asyncio
+import time
+
+import qa_agent
+
+RETRIEVAL_SECONDS = 2
+
+
+async def slow_retrieval(query):
+    # Like hybrid_search_async(): the work happens on an executor thread,
+    # which cancelling the awaiting task can't stop
+    await asyncio.to_thread(time.sleep, RETRIEVAL_SECONDS)
+    return []
+
+
+async def fake_course(course_id):
+    prereqs = {"COMP 250": "COMP 202 or COMP 204", "COMP 202": ""}
+    return {"id": course_id, "title": f"Course {course_id}", "prereqs": prereqs.get(course_id), "coreqs": ""}
+
+
+def test_deterministic_answer_does_not_wait_for_retrieval(monkeypatch):
+    monkeypatch.setattr(qa_agent, "hybrid_search_async", slow_retrieval)
+    monkeypatch.setattr(qa_agent, "get_course_directly_async", fake_course)
+
+    start = time.monotonic()
+    result = qa_agent.generate_answer("Should I take COMP 202 before COMP 250?")
+    elapsed = time.monotonic() - start
+
+    assert result["answer"].startswith("**Yes**")
+    assert elapsed < RETRIEVAL_SECONDS / 2
+
+
+def test_streamed_deterministic_answer_does_not_wait_for_retrieval(monkeypatch):
+    monkeypatch.setattr(qa_agent, "hybrid_search_async", slow_retrieval)
+    monkeypatch.setattr(qa_agent, "get_course_directly_async", fake_course)
+
+    start = time.monotonic()
+    pieces = list(qa_agent.stream_answer("Should I take COMP 202 before COMP 250?"))
+    elapsed = time.monotonic() - start
+
+    assert len(pieces) == 1 and pieces[0].startswith("**Yes**")
+    assert elapsed < RETRIEVAL_SECONDS / 2
@@ -0,0 +1,300 @@
+# Concurrency in rag_layer: semantic-search batching, hybrid_search single-flight
+# and the cross-process course snapshot lock. Chroma and the embedding model are
+# replaced with fakes, so only the coordination logic runs.
+import importlib.util
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import rag_layer
+
+
+class FakeCollection:
+    """Answers every query vector with ids "<vector> 0", "<vector> 1", ..."""
+
+    def __init__(self):
+        self.calls = []
+
+    def query(self, query_embeddings, n_results, where, include):
+        self.calls.append((list(query_embeddings), n_results, where))
+        return {
+            "ids": [[f"{v} {i}" for i in range(n_results)] for v in query_embeddings],
+            "distances": [[i / 10 for i in range(n_results)] for v in query_embeddings],
+            "metadatas": [[{"title": v, "level": "intro"}] * n_results for v in query_embeddings],
+        }
+
+
+@pytest.fixture
+def fake_index(monkeypatch):
+    collection = FakeCollection()
+    embed_calls = []
+
+    def embed(texts):
+        embed_calls.append(list(texts))
+        return [text.upper() for text in texts]
+
+    monkeypatch.setattr(rag_layer, "_get_collection", lambda: collection)
+    monkeypatch.setattr(rag_layer, "_get_embedding_fn", lambda: embed)
+    return collection, embed_calls
+
+
+def test_batcher_embeds_concurrent_queries_once_and_groups_by_filter(fake_index):
+    collection, embed_calls = fake_index
+    # A long hold, so every query below lands in the same batch
+    batcher = rag_layer.EmbeddingBatcher(max_batch_size=10, max_batch_hold=0.5)
+    comp = {"department": "COMP"}
+    futures = [
+        batcher.submit("a", 2),
+        batcher.submit("b", 3, comp),
+        batcher.submit("c", 1),
+        batcher.submit("d", 2, comp),
+    ]
+    results = [f.result(timeout=5) for f in futures]
+
+    assert embed_calls == [["a", "b", "c", "d"]]
+    # One Chroma call per distinct filter, asking for the group's largest n_results
+    assert sorted((vectors, n, str(where)) for vectors, n, where in collection.calls) == [
+        (["A", "C"], 2, "None"),
+        (["B", "D"], 3, str(comp)),
+    ]
+    # Each caller gets its own query's rows, cut to its own n_results
+    assert [[r["course_id"] for r in rows] for rows in results] == [
+        ["A 0", "A 1"], ["B 0", "B 1", "B 2"], ["C 0"], ["D 0", "D 1"],
+    ]
+    assert results[0][0]["title"] == "A"
+
+
+def test_batcher_flushes_when_the_batch_is_full(fake_index):
+    _, embed_calls = fake_index
+    batcher = rag_layer.EmbeddingBatcher(max_batch_size=2, max_batch_hold=5)
+    futures = [batcher.submit(q, 1) for q in "abcd"]
+    for f in futures:
+        f.result(timeout=2)  # well under the hold: full batches don't wait for it
+    assert sorted(len(batch) for batch in embed_calls) == [2, 2]
+
+
+def test_batcher_fails_every_query_of_a_batch_that_could_not_be_embedded(monkeypatch):
+    def broken(texts):
+        raise RuntimeError("model not loaded")
+
+    monkeypatch.setattr(rag_layer, "_get_collection", FakeCollection)
+    monkeypatch.setattr(rag_layer, "_get_embedding_fn", lambda: broken)
+    batcher = rag_layer.EmbeddingBatcher(max_batch_size=10, max_batch_hold=0.2)
+    futures = [batcher.submit(q, 1) for q in "ab"]
+    for f in futures:
+        with pytest.raises(RuntimeError, match="model not loaded"):
+            f.result(timeout=5)
+
+
+@pytest.fixture
+def slow_pipeline(monkeypatch):
+    """Replace the hybrid pipeline with one that blocks until `release` is set."""
+    rag_layer.invalidate_search_cache()
+    release = threading.Event()
+    calls = []
+    outcome = {"raise": None}
+
+    def pipeline(query, dept=None, prereq_of=None, n_results=50):
+        calls.append(query)
+        release.wait(5)
+        if outcome["raise"]:
+            raise outcome["raise"]
+        return [{"course_id": "COMP 250", "title": "Intro"}]
+
+    monkeypatch.setattr(rag_layer, "_hybrid_search", pipeline)
+    yield release, calls, outcome
+    rag_layer.invalidate_search_cache()
+
+
+def _search_from_threads(n, query="comp 250"):
+    """Start n hybrid_search(query) threads; return (threads, results, errors)."""
+    results, errors = [None] * n, [None] * n
+
+    def run(i):
+        try:
+            results[i] = rag_layer.hybrid_search(query)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, results, errors
+
+
+def _wait_for_inflight():
+    for _ in range(500):
+        if rag_layer._hybrid_inflight:
+            return
+        time.sleep(0.01)
+    raise AssertionError("no search became in-flight")
+
+
+def test_concurrent_identical_searches_run_the_pipeline_once(slow_pipeline):
+    release, calls, _ = slow_pipeline
+    threads, results, errors = _search_from_threads(4)
+    _wait_for_inflight()
+    time.sleep(0.2)  # let the followers queue up behind the leader
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert calls == ["comp 250"]
+    assert errors == [None] * 4
+    assert all(r == [{"course_id": "COMP 250", "title": "Intro"}] for r in results)
+    # Every caller gets its own copy, so editing one result can't leak into another
+    assert len({id(r[0]) for r in results}) == 4
+    assert not rag_layer._hybrid_inflight
+
+
+def test_a_failed_search_fails_its_waiters_and_is_not_remembered(slow_pipeline):
+    release, calls, outcome = slow_pipeline
+    outcome["raise"] = RuntimeError("db down")
+    threads, results, errors = _search_from_threads(3)
+    _wait_for_inflight()
+    time.sleep(0.2)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert calls == ["comp 250"]
+    assert all(isinstance(e, RuntimeError) and str(e) == "db down" for e in errors)
+    assert not rag_layer._hybrid_inflight
+    # Nothing was cached, so the next call runs the pipeline again
+    outcome["raise"] = None
+    assert rag_layer.hybrid_search("comp 250") == [{"course_id": "COMP 250", "title": "Intro"}]
+    assert len(calls) == 2
+
+
+def test_inflight_entry_outlives_the_cache_put(slow_pipeline, monkeypatch):
+    release, _, _ = slow_pipeline
+    release.set()
+    seen = []
+    put = rag_layer._search_cache_put
+
+    def checking_put(key, results):
+        # A caller arriving now must find either the in-flight Future or the cache
+        seen.append(key in rag_layer._hybrid_inflight)
+        put(key, results)
+
+    monkeypatch.setattr(rag_layer, "_search_cache_put", checking_put)
+    rag_layer.hybrid_search("comp 250")
+    assert seen == [True]
+    assert not rag_layer._hybrid_inflight
+
+
+class _Row:
+    def __init__(self, course_id):
+        self.id = course_id
+        self._mapping = {"id": course_id, "title": "Intro", "credits": 3}
+
+
+class _CountingSession:
+    """DBSession stand-in that records each full-table load in a file, slowly."""
+
+    log_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement):
+        with open(self.log_path, "a") as f:
+            f.write(f"{os.getpid()}\n")
+        time.sleep(0.5)  # long enough for every other process to reach the lock
+        return [_Row("COMP 250"), _Row("MATH 133")]
+
+
+def _load_in_child(results):
+    rag_layer._load_course_cache()
+    results.put(sorted(rag_layer._course_cache))
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "fork") or importlib.util.find_spec("fcntl") is None,
+    reason="the snapshot lock is POSIX-only",
+)
+def test_processes_starting_together_load_the_course_table_once(tmp_path, monkeypatch):
+    _CountingSession.log_path = tmp_path / "loads.log"
+    monkeypatch.setattr(rag_layer, "COURSE_CACHE_PATH", tmp_path / "courses.pkl")
+    monkeypatch.setattr(rag_layer, "DBSession", _CountingSession)
+    monkeypatch.setattr(rag_layer, "_course_cache", {})
+    monkeypatch.setattr(rag_layer, "_course_cache_loaded", False)
+
+    # Forked children inherit the patches above, like uvicorn workers inherit the app
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    children = [ctx.Process(target=_load_in_child, args=(results,)) for _ in range(4)]
+    for p in children:
+        p.start()
+    loaded = [results.get(timeout=20) for _ in children]
+    for p in children:
+        p.join(5)
+
+    assert loaded == [["COMP 250", "MATH 133"]] * 4
+    # One process went to the DB; the rest waited on the lock and read its pickle
+    assert len(_CountingSession.log_path.read_text().splitlines()) == 1
+
+
+def test_invalidated_snapshot_is_not_read_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_layer, "COURSE_CACHE_PATH", tmp_path / "courses.pkl")
+    rag_layer._write_course_cache_file({"COMP 250": {"id": "COMP 250", "title": "Old title"}})
+    assert rag_layer._read_course_cache_file() is not None
+
+    rag_layer.invalidate_course_snapshot()
+    assert rag_layer._read_course_cache_file() is None
+    rag_layer.invalidate_course_snapshot()  # nothing to delete is fine too
+
+
+def test_course_refresh_makes_cached_hybrid_results_unreachable(slow_pipeline, monkeypatch):
+    release, calls, _ = slow_pipeline
+    release.set()
+    rag_layer.hybrid_search("comp 250")
+    rag_layer.hybrid_search("comp 250")
+    assert len(calls) == 1
+
+    monkeypatch.setattr(rag_layer, "_course_cache_generation", rag_layer._course_cache_generation + 1)
+    rag_layer.hybrid_search("comp 250")
+    assert len(calls) == 2
+
+
+def test_refresh_resolves_renamed_titles(tmp_path, monkeypatch):
+    titles = {"COMP 250": "Data Structures", "MATH 133": "Linear Algebra"}
+
+    class CatalogueSession(_CountingSession):
+        def execute(self, statement):
+            rows = [_Row(course_id) for course_id in titles]
+            for row in rows:
+                row._mapping["title"] = titles[row.id]
+            return rows
+
+    monkeypatch.setattr(rag_layer, "COURSE_CACHE_PATH", tmp_path / "courses.pkl")
+    monkeypatch.setattr(rag_layer, "DBSession", CatalogueSession)
+    # Restored afterwards, so the fake catalogue doesn't leak into other tests
+    for name in ("_course_cache", "_title_to_id_cache", "_id_to_title_cache",
+                 "_duplicate_titles", "_known_departments"):
+        monkeypatch.setattr(rag_layer, name, type(getattr(rag_layer, name))())
+    for name in ("_course_cache_loaded", "_cache_loaded"):
+        monkeypatch.setattr(rag_layer, name, False)
+    monkeypatch.setattr(rag_layer, "_course_cache_generation", rag_layer._course_cache_generation)
+    rag_layer._find_course_by_title_normalized.cache_clear()
+    rag_layer._extract_course_id_stripped.cache_clear()
+
+    question = "What is Data Structures about?"
+    assert rag_layer.extract_course_id(question) == ("COMP 250", None)
+
+    # The scraper renames both courses, then the server refreshes its table
+    titles.update({"COMP 250": "Algorithms and Data", "MATH 133": "Data Structures"})
+    rag_layer.refresh_course_cache()
+
+    # Asked again, the memoized answer must not win over the new titles
+    assert rag_layer.extract_course_id(question) == ("MATH 133", None)
+    assert rag_layer.extract_course_id("Tell me about Algorithms and Data") == ("COMP 250", None)
+
+    rag_layer._find_course_by_title_normalized.cache_clear()
+    rag_layer._extract_course_id_stripped.cache_clear()
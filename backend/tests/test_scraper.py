@@ -0,0 +1,120 @@
+# Rate limiting: the shared TokenBucket and the 429/503 backoff in fetch_page_async().
+import asyncio
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+import scraper
+from scraper import TokenBucket
+
+
+def test_bucket_serves_a_burst_without_waiting():
+    bucket = TokenBucket(rate_per_sec=1.0, burst=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+def test_bucket_paces_requests_past_the_burst():
+    bucket = TokenBucket(rate_per_sec=20.0, burst=2)
+    start = time.monotonic()
+    for _ in range(2 + 6):
+        bucket.acquire()
+    # 6 tokens beyond the burst at 20/s
+    assert time.monotonic() - start >= 6 / 20 - 0.02
+
+
+def test_bucket_is_shared_fairly_between_threads():
+    bucket = TokenBucket(rate_per_sec=50.0, burst=1)
+    per_thread, threads = 5, 4
+    start = time.monotonic()
+    workers = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(per_thread)])
+               for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    # Every token after the first is paid for once, whichever thread takes it
+    assert time.monotonic() - start >= (per_thread * threads - 1) / 50 - 0.02
+
+
+def test_pause_holds_back_the_next_acquire():
+    bucket = TokenBucket(rate_per_sec=100.0, burst=10)
+    bucket.pause(0.2)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.18
+
+
+def test_acquire_async_waits_like_acquire():
+    bucket = TokenBucket(rate_per_sec=20.0, burst=1)
+
+    async def take(n):
+        for _ in range(n):
+            await bucket.acquire_async()
+
+    start = time.monotonic()
+    asyncio.run(take(5))
+    assert time.monotonic() - start >= 4 / 20 - 0.02
+
+
+async def _fetch_from(handler, monkeypatch, **kwargs):
+    """Run fetch_page_async(**kwargs) against a local server answering with `handler`."""
+    monkeypatch.setattr(scraper, "_BUCKET", TokenBucket(rate_per_sec=1000.0, burst=100))
+    app = web.Application()
+    app.router.add_get("/{page}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            return await scraper.fetch_page_async(
+                session, f"http://127.0.0.1:{port}/page", asyncio.Semaphore(1), **kwargs)
+    finally:
+        await runner.cleanup()
+
+
+def test_rate_limited_page_retries_once_per_backoff_step(monkeypatch):
+    monkeypatch.setattr(scraper, "RATE_LIMIT_BACKOFF", (0.01, 0.01))
+    hits = []
+
+    async def always_429(request):
+        hits.append(1)
+        return web.Response(status=429)
+
+    try:
+        asyncio.run(_fetch_from(always_429, monkeypatch))
+    except aiohttp.ClientResponseError as e:
+        assert e.status == 429
+    else:
+        raise AssertionError("expected the 429 to be raised")
+    # Two backoff waits, then the last attempt's 429 is raised — the outer
+    # network-error retries don't start the sequence over
+    assert len(hits) == 3
+
+
+def test_rate_limited_page_succeeds_after_backing_off(monkeypatch):
+    monkeypatch.setattr(scraper, "RATE_LIMIT_BACKOFF", (0.01, 0.01))
+    hits = []
+
+    async def busy_then_ok(request):
+        hits.append(1)
+        if len(hits) == 1:
+            return web.Response(status=503)
+        return web.Response(text="<html>ok</html>", content_type="text/html", headers={"ETag": '"v2"'})
+
+    status, html, etag, _ = asyncio.run(_fetch_from(busy_then_ok, monkeypatch))
+    assert (status, html, etag, len(hits)) == (200, "<html>ok</html>", '"v2"', 2)
+
+
+def test_unchanged_page_answers_304_with_the_old_validators(monkeypatch):
+    async def not_modified(request):
+        assert request.headers["If-None-Match"] == '"v1"'
+        return web.Response(status=304)
+
+    result = asyncio.run(_fetch_from(not_modified, monkeypatch, etag='"v1"'))
+    assert result == (304, "", '"v1"', None)
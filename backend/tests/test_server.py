@@ -0,0 +1,93 @@
+# /courses/{course_id}: response caching, ETag validation and invalidation.
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import rag_layer
+import server
+from db_setup import Base, Course
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """A throwaway SQLite database holding COMP 250, wired in as the server's session."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'courses.db'}")
+    Base.metadata.create_all(engine, tables=[Course.__table__])
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        session.add(Course(id="COMP 250", title="Introduction to Computer Science",
+                           description="Data structures.", credits=3, offered_by="Computer Science",
+                           offered_fall=True, prereq_text="COMP 202", coreq_text=""))
+        session.commit()
+    monkeypatch.setattr(server, "DBSession", Session)
+    server._course_response.cache_clear()
+    yield Session
+    server._course_response.cache_clear()
+
+
+@pytest.fixture
+def client(db):
+    return TestClient(server.app)  # no `with`: the lifespan (vector store build) isn't needed
+
+
+def test_course_is_served_with_validators(client):
+    response = client.get("/courses/COMP 250")
+    assert response.status_code == 200
+    assert response.json()["prereq_text"] == "COMP 202"
+    assert response.headers["ETag"].startswith('"')
+    assert response.headers["Cache-Control"] == server.COURSE_CACHE_CONTROL
+
+
+def test_matching_etag_gets_304_without_a_body(client):
+    etag = client.get("/courses/COMP 250").headers["ETag"]
+    for header in (etag, f'"other", {etag}', "*"):
+        response = client.get("/courses/COMP 250", headers={"If-None-Match": header})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["ETag"] == etag
+
+
+def test_stale_etag_gets_the_full_response(client):
+    response = client.get("/courses/COMP 250", headers={"If-None-Match": '"not-it"'})
+    assert response.status_code == 200
+    assert response.json()["id"] == "COMP 250"
+
+
+def test_unknown_course_is_404_and_not_cached(client, db):
+    assert client.get("/courses/COMP 999").status_code == 404
+    with db() as session:
+        session.add(Course(id="COMP 999", title="New", description="", credits=3, offered_by="CS"))
+        session.commit()
+    assert client.get("/courses/COMP 999").status_code == 200
+
+
+def _edit_prereqs(Session, text):
+    with Session() as session:
+        session.get(Course, "COMP 250").prereq_text = text
+        session.commit()
+
+
+def test_course_refresh_invalidates_cached_responses(client, db, monkeypatch):
+    old_etag = client.get("/courses/COMP 250").headers["ETag"]
+    _edit_prereqs(db, "COMP 206")
+    # Still cached until the course data is refreshed...
+    assert client.get("/courses/COMP 250").headers["ETag"] == old_etag
+
+    monkeypatch.setattr(rag_layer, "_course_cache_generation", rag_layer._course_cache_generation + 1)
+    response = client.get("/courses/COMP 250", headers={"If-None-Match": old_etag})
+    assert response.status_code == 200
+    assert response.json()["prereq_text"] == "COMP 206"
+    assert response.headers["ETag"] != old_etag
+
+
+def test_cached_responses_expire_with_the_max_age_window(client, db, monkeypatch):
+    now = 1_000_000 * server.COURSE_CACHE_MAX_AGE
+    monkeypatch.setattr(server.time, "time", lambda: now)
+    old_etag = client.get("/courses/COMP 250").headers["ETag"]
+    _edit_prereqs(db, "COMP 206")  # e.g. update_prereq_text, running in another process
+
+    now += server.COURSE_CACHE_MAX_AGE
+    response = client.get("/courses/COMP 250", headers={"If-None-Match": old_etag})
+    assert response.status_code == 200
+    assert response.json()["prereq_text"] == "COMP 206"
@@ -1,59 +1,146 @@
 import re
-from scraper import fetch_html, parse_course_page
+from scraper import BASE_URL, FETCH_WINDOW, course_slug, fetch_many_pages, parse_course_page
+from sqlalchemy import bindparam, func, select, update
 from db_connection import Session
 from db_setup import Course
+from ensure_columns import ensure_columns
+from rag_layer import invalidate_course_snapshot
+
+BATCH_SIZE = 100  # updated courses per commit (one round-trip + fsync per batch, not per course)
+PROGRESS_EVERY = 50  # print a progress line every N courses, not several lines per course
+
+# Core UPDATE on the courses table, not the ORM bulk path: rows are plain dicts, so
+# there's no mapper or identity-map bookkeeping per row. With no .values(), the SET
+# clause is built from the keys of the parameter rows; the WHERE binds "course_id"
+# because a parameter named after a column would land in SET instead.
+UPDATE_COURSE = update(Course.__table__).where(Course.__table__.c.id == bindparam("course_id"))
+
+
+def commit_batch(session, batch: list, errors: list):
+    """Write the pending updates in one statement and commit.
+
+    batch holds one {'course_id': ..., <field>: <new value>} row per course changed
+    since the last commit. UPDATE_COURSE with a list of rows is an UPDATE ... WHERE id = ?
+    sent once with every row as a parameter set (executemany), instead of one flush
+    per course. If it fails, the whole transaction is rolled back, so the rows are
+    retried one course at a time — one bad row then costs only itself, not the
+    other 99.
+    """
+    if not batch:
+        return
+    try:
+        session.execute(UPDATE_COURSE, batch)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"   ⚠️  Batch update failed ({e}), retrying {len(batch)} courses one by one...")
+        for row in batch:
+            try:
+                session.execute(UPDATE_COURSE, [row])
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                print(f"   ❌ Error updating {row['course_id']}: {str(e)}")
+                errors.append(row['course_id'])
+    batch.clear()
+
+
+def stream_courses_with_pages(read_session):
+    """Yield (course, (url, page)) for every course, FETCH_WINDOW courses at a time.
+
+    Courses are plain rows of just the columns main() uses, streamed from a
+    server-side cursor (yield_per), so only one window of rows and pages is in
+    memory at once and the first window's fetches start without waiting for the
+    rest of the table. Pages are downloaded concurrently (fetch_many_pages: pooled
+    connections, FETCH_CONCURRENCY requests in flight) and come back in order, so
+    parsing and the sessions — which aren't thread-safe — stay on this thread.
+    """
+    stmt = select(Course.id, Course.prereq_text, Course.coreq_text,
+                  Course.etag, Course.last_modified)
+    result = read_session.execute(stmt.execution_options(yield_per=FETCH_WINDOW))
+    for courses in result.partitions():
+        # Generate the URL for each course
+        urls = [f"{BASE_URL}{course_slug(course.id)}/index.html" for course in courses]
+        # Each request carries the ETag/Last-Modified the page was last served with,
+        # so pages that haven't changed since the previous run come back as a bodyless 304
+        validators = [(course.etag, course.last_modified) for course in courses]
+        yield from zip(courses, fetch_many_pages(urls, validators))
 
-BASE_URL = "https://coursecatalogue.mcgill.ca/courses/"
 
 def main():
     print("🔄 Updating prerequisite and corequisite text for existing courses...")
+    ensure_columns()  # etag/last_modified on databases created before they existed
     
-    with Session() as session:
-        # Get all courses from the database
-        courses = session.query(Course).all()
-        total = len(courses)
+    # Two sessions: the read session's cursor stays open for the whole run, and
+    # committing a batch would end its transaction, so writes go through their own
+    with Session() as read_session, Session() as session:
+        # One cheap COUNT up front, for the progress counter
+        total = read_session.scalar(select(func.count()).select_from(Course))
         print(f"Found {total} courses in database to update")
         
-        for idx, course in enumerate(courses, start=1):
-            # Generate the URL for the course
-            url_safe_id = course.id.replace(' ', '-').lower()
-            course_url = f"{BASE_URL}{url_safe_id}/index.html"
-            
-            print(f"({idx}/{total}) 📄 Updating {course.id} - {course.title}...")
+        batch = []   # {'course_id', changed fields} rows waiting for the next bulk UPDATE
+        errors = []  # course IDs that couldn't be updated
+        unchanged = 0  # pages the catalogue answered 304 Not Modified for
+        updated_text = 0  # prereq/coreq fields filled in
+        
+        pages = stream_courses_with_pages(read_session)
+        for idx, (course, (course_url, page)) in enumerate(pages, start=1):
+            if idx % PROGRESS_EVERY == 0 or idx == 1:
+                print(f"[{idx}/{total}] 📄 Updating... ({100 * idx // max(total, 1)}%)")
             
             try:
-                # Fetch the page and use your existing parsing logic
-                course_html = fetch_html(course_url)
+                if isinstance(page, Exception):
+                    raise page  # fetch failed after retries
+                status, course_html, etag, last_modified = page
+                if status == 304:
+                    # Same page as last run: nothing to parse, nothing to write
+                    unchanged += 1
+                    continue
+                # Use your existing parsing logic
                 parsed_data = parse_course_page(course_html, course_url)
                 
                 # Update just the prereq and coreq text fields if new data exists
-                updated = False
-                if 'prereq_text' in parsed_data and parsed_data['prereq_text']:
-                    if not course.prereq_text:
-                        course.prereq_text = parsed_data['prereq_text']
-                        print(f"   ✅ Updated prereq text: {parsed_data['prereq_text'][:50]}...")
-                        updated = True
-                    else:
-                        print("   ℹ️  Prereq text already present, not overwriting.")
+                # (text that's already present is never overwritten)
+                changes = {}
+                if parsed_data.get('prereq_text') and not course.prereq_text:
+                    changes['prereq_text'] = parsed_data['prereq_text']
+                    updated_text += 1
+                
+                if parsed_data.get('coreq_text') and not course.coreq_text:
+                    changes['coreq_text'] = parsed_data['coreq_text']
+                    updated_text += 1
                 
-                if 'coreq_text' in parsed_data and parsed_data['coreq_text']:
-                    if not course.coreq_text:
-                        course.coreq_text = parsed_data['coreq_text']
-                        print(f"   ✅ Updated coreq text: {parsed_data['coreq_text'][:50]}...")
-                        updated = True
-                    else:
-                        print("   ℹ️  Coreq text already present, not overwriting.")
+                # Remember the page's new validators so the next run can skip it
+                if (etag, last_modified) != (course.etag, course.last_modified):
+                    changes['etag'] = etag
+                    changes['last_modified'] = last_modified
                 
-                # Commit only if we wrote new data
-                if updated:
-                    session.commit()
-                else:
-                    session.rollback()
+                # Only courses we wrote new data to go into the batch
+                if changes:
+                    # Every row carries every column (unchanged ones keep the loaded value),
+                    # so the whole batch shares one statement instead of splitting by key set
+                    batch.append({'course_id': course.id, 'prereq_text': course.prereq_text,
+                                  'coreq_text': course.coreq_text, 'etag': course.etag,
+                                  'last_modified': course.last_modified, **changes})
+                    if len(batch) >= BATCH_SIZE:
+                        commit_batch(session, batch, errors)
                 
             except Exception as e:
+                # Fetch/parse failed: nothing was written for this course, and the
+                # batch's other updates stay pending
                 print(f"   ❌ Error updating {course.id}: {str(e)}")
-                session.rollback()
+                errors.append(course.id)
+        
+        # Final (partial) batch
+        commit_batch(session, batch, errors)
+    # The server's disk snapshot of the courses table predates these updates
+    invalidate_course_snapshot()
 
+    print(f"✏️  Filled in {updated_text} prerequisite/corequisite texts")
+    if unchanged:
+        print(f"⏭️  {unchanged} courses unchanged since the last run")
+    if errors:
+        print(f"⚠️  {len(errors)} courses could not be updated: {', '.join(errors)}")
     print("✅ Update complete!")
 
 if __name__ == "__main__":